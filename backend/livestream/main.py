@@ -1,17 +1,85 @@
 import cv2
 import uvicorn
 import numpy as np
-import json
-from fastapi import FastAPI, Request, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse, HTMLResponse
+import orjson
+from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, HTMLResponse, ORJSONResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
-import threading
-import time
+from pydantic import BaseModel
 import asyncio
-from typing import Dict, Any
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from contextlib import asynccontextmanager
+from multiprocessing import shared_memory
+from collections import deque
+from functools import lru_cache
+from typing import Dict, Any, List, Tuple
 import os
+import sys
+import time
+
+# libjpeg-turbo (SIMD) codec for the burn-in path; falls back to OpenCV if unavailable
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    tj = TurboJPEG()
+except Exception as e:
+    print(f"TurboJPEG unavailable, using OpenCV codec: {e}")
+    tj = None
+
+# WebRTC (H.264/VP8) viewers are optional; MJPEG keeps working without aiortc
+try:
+    from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+    from av import VideoFrame
+except ImportError as e:
+    print(f"aiortc unavailable, WebRTC viewers disabled: {e}")
+    RTCPeerConnection = None
+
+# Quality and chroma subsampling used when re-encoding burned-in frames
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", 80))
+CV2_JPEG_PARAMS = [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY, int(cv2.IMWRITE_JPEG_OPTIMIZE), 0]
+# OpenCV < 4.7 has no sampling-factor flag and keeps its own default subsampling
+if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):
+    CV2_JPEG_PARAMS += [int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR), cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420]
+
+# Threads for JPEG decode/draw/encode in the burn-in path
+codec_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Decode-time downscaling supported by both libjpeg-turbo and OpenCV
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
 
-app = FastAPI(title="Live Stream Hub")
+# Maximum number of simultaneous viewers (MJPEG and WebRTC together); 0 means unlimited
+MAX_VIEWERS = int(os.getenv("MAX_VIEWERS", 0))
+mjpeg_viewers = 0
+peer_connections = set()
+
+# Cameras whose producer runs on this machine and hands frames over through shared memory
+# instead of the WebSocket, e.g. SHM_CAMERAS=cam1,cam2
+SHM_CAMERAS = [camera_id for camera_id in os.getenv("SHM_CAMERAS", "").split(",") if camera_id]
+# Layout must match model/vision-model/main.py: header (seq: u64, jpeg_len: u32, meta_len: u32)
+# followed by the JPEG and the detections JSON. seq is odd while a write is in progress.
+SHM_HEADER = struct.Struct("<QII")
+SHM_POLL_INTERVAL = 0.005
+# A shared-memory camera with no new frame for this long is reported as disconnected
+SHM_STALE_SECONDS = 5.0
+# Same for a camera that pushes over HTTP, since it has no connection that closes
+PUSH_STALE_SECONDS = 5.0
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    pollers = [asyncio.create_task(watch_shared_memory(camera_id)) for camera_id in SHM_CAMERAS]
+    yield
+    for poller in pollers:
+        poller.cancel()
+    await asyncio.gather(*(pc.close() for pc in list(peer_connections)))
+
+app = FastAPI(title="Live Stream Hub", lifespan=lifespan)
 
 # Allow all origins
 app.add_middleware(
@@ -22,66 +90,281 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Store the latest frame and metadata for each camera
-# Format: {camera_id: {'image': bytes, 'metadata': dict}}
+# A published frame: (image_bytes, metadata, seq, multipart_header). Frames are immutable,
+# so readers always see a consistent image/metadata pair.
+# The multipart header is built once at publish time and shared by every viewer; the image
+# bytes are yielded after it as-is, so they are never copied into a bigger buffer.
+Frame = Tuple[bytes, Dict[str, Any], int, bytes]
+
+# Number of recent frames kept per stream, so viewers can absorb short producer bursts
+FRAME_RING_SIZE = 3
+
+# Store the most recent frames for each camera
+# Format: {camera_id: {'frames': deque[Frame], 'seq': int, 'metadata': dict, 'event': asyncio.Event}}
+# 'metadata' holds the most recent detections, attached to the next frame pushed.
 streams: Dict[str, Dict[str, Any]] = {}
 
-# Lock for thread safety
-stream_lock = threading.Lock()
+def new_stream(**fields) -> Dict[str, Any]:
+    return {'frames': deque(maxlen=FRAME_RING_SIZE), 'seq': 0, 'event': asyncio.Event(), **fields}
+
+def frames_since(stream: Dict[str, Any], last_seq: int) -> List[Frame]:
+    """Frames in the stream's ring newer than last_seq, oldest first."""
+    return [frame for frame in stream['frames'] if frame[2] > last_seq]
+
+def multipart_header(content_type: bytes, length: int) -> bytes:
+    # The CRLF closing the previous part is sent as part of the next delimiter
+    # (before the first part it is just preamble), so bodies need no trailer.
+    return (b'\r\n--frame\r\n'
+            b'Content-Type: ' + content_type + b'\r\n'
+            b'Content-Length: ' + str(length).encode() + b'\r\n\r\n')
+
+def publish_frame(stream: Dict[str, Any], image: bytes, metadata: Dict[str, Any]):
+    """Appends a new frame to the stream's ring and wakes every viewer waiting on it."""
+    stream['seq'] += 1
+    stream['frames'].append((image, metadata, stream['seq'], multipart_header(b'image/jpeg', len(image))))
+    stream['event'].set()
+    stream['event'].clear()
+
+def split_frames(data: bytes) -> List[bytes]:
+    """
+    A binary push message is either one JPEG, or several frames each prefixed with their
+    4-byte big-endian length (a JPEG starts with FF D8, which no sane length prefix does).
+    """
+    if data[:2] == b'\xff\xd8':
+        return [data]
+    frames = []
+    view = memoryview(data)
+    offset = 0
+    while offset + 4 <= len(view):
+        length = int.from_bytes(view[offset:offset + 4], 'big')
+        offset += 4
+        frames.append(bytes(view[offset:offset + length]))
+        offset += length
+    return frames
 
 @app.websocket("/ws/push/{camera_id}")
 async def websocket_endpoint(websocket: WebSocket, camera_id: str):
     await websocket.accept()
+    stream = new_stream(metadata={})
+    streams[camera_id] = stream
     try:
         while True:
             # Handle both text (metadata) and bytes (frame)
             # We use recieve() to get a Message object that has .type
             message = await websocket.receive()
-            
-            with stream_lock:
-                if camera_id not in streams:
-                    streams[camera_id] = {'image': None, 'metadata': {}}
-                
-                if message["type"] == "websocket.receive":
-                    if "bytes" in message and message["bytes"] is not None:
-                        streams[camera_id]['image'] = message["bytes"]
-                    elif "text" in message and message["text"] is not None:
-                         try:
-                             meta = json.loads(message["text"])
-                             if meta.get("type") == "detections":
-                                 streams[camera_id]['metadata'] = meta
-                         except json.JSONDecodeError:
-                             pass
+
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+
+            if message["type"] == "websocket.receive":
+                if "bytes" in message and message["bytes"] is not None:
+                    for image in split_frames(message["bytes"]):
+                        publish_frame(stream, image, stream['metadata'])
+                elif "text" in message and message["text"] is not None:
+                     try:
+                         meta = orjson.loads(message["text"])
+                         if meta.get("type") == "detections":
+                             stream['metadata'] = meta
+                     except orjson.JSONDecodeError:
+                         pass
     except WebSocketDisconnect:
         print(f"Camera {camera_id} disconnected")
     except Exception as e:
         print(f"Error in websocket {camera_id}: {e}")
     finally:
-        with stream_lock:
-            # Maybe keep last frame for a bit? Or delete immediately?
-            # Deleting for now to avoid stale streams
-            if camera_id in streams:
+        # Deleting to avoid stale streams (only if a reconnect hasn't replaced us)
+        if streams.get(camera_id) is stream:
+            del streams[camera_id]
+        # Wake viewers so they notice the camera is gone
+        stream['event'].set()
+
+@app.post("/push/{camera_id}")
+async def push_frame(camera_id: str, request: Request):
+    """
+    HTTP alternative to the WebSocket push: the request body is one raw JPEG frame.
+    The body is read as a single buffer instead of being spooled through UploadFile.
+    """
+    body = await request.body()
+    if not body:
+        raise HTTPException(status_code=400, detail="Empty frame")
+
+    now = asyncio.get_running_loop().time()
+    stream = streams.get(camera_id)
+    if stream is None:
+        stream = new_stream(metadata={}, last_push=now)
+        streams[camera_id] = stream
+        stream['expiry'] = asyncio.create_task(expire_pushed_stream(camera_id, stream))
+    stream['last_push'] = now
+    publish_frame(stream, body, stream['metadata'])
+    return {"status": "ok"}
+
+async def expire_pushed_stream(camera_id: str, stream: Dict[str, Any]):
+    """Drops a stream created by /push once its camera stops posting frames."""
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            idle = loop.time() - stream['last_push']
+            if idle >= PUSH_STALE_SECONDS:
+                print(f"Camera {camera_id} disconnected")
+                break
+            await asyncio.sleep(PUSH_STALE_SECONDS - idle)
+    finally:
+        if streams.get(camera_id) is stream:
+            del streams[camera_id]
+        # Wake viewers so they notice the camera is gone
+        stream['event'].set()
+
+def attach_shared_frames(camera_id: str) -> shared_memory.SharedMemory:
+    name = f"crowdshield_{camera_id}"
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track flag; keep the resource tracker from unlinking
+        # the producer's segment when the hub exits
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+def read_shared_frame(shm: shared_memory.SharedMemory, last_seq: int):
+    """Returns (seq, image, metadata_json) for a new complete frame, or None."""
+    seq, image_len, meta_len = SHM_HEADER.unpack_from(shm.buf)
+    if seq == last_seq or seq & 1:
+        return None
+    start = SHM_HEADER.size
+    image = bytes(shm.buf[start:start + image_len])
+    meta = bytes(shm.buf[start + image_len:start + image_len + meta_len])
+    # The producer started another write while we were copying
+    if SHM_HEADER.unpack_from(shm.buf)[0] != seq:
+        return None
+    return seq, image, meta
+
+async def watch_shared_memory(camera_id: str):
+    """Publishes the frames a same-host producer writes into shared memory for camera_id."""
+    loop = asyncio.get_running_loop()
+    shm = None
+    stream = None
+    last_seq = 0
+    last_frame_time = 0.0
+    try:
+        while True:
+            if shm is None:
+                try:
+                    shm = attach_shared_frames(camera_id)
+                except FileNotFoundError:
+                    # Producer not started yet
+                    await asyncio.sleep(1)
+                    continue
+                last_frame_time = loop.time()
+
+            frame = read_shared_frame(shm, last_seq)
+            if frame is None:
+                if loop.time() - last_frame_time > SHM_STALE_SECONDS:
+                    # Producer stopped (or restarted with a new segment): drop the stream and reattach
+                    if stream is not None:
+                        print(f"Camera {camera_id} disconnected")
+                        if streams.get(camera_id) is stream:
+                            del streams[camera_id]
+                        stream['event'].set()
+                        stream = None
+                    shm.close()
+                    shm = None
+                await asyncio.sleep(SHM_POLL_INTERVAL)
+                continue
+
+            last_seq, image, meta = frame
+            last_frame_time = loop.time()
+            if stream is None:
+                print(f"Camera {camera_id} connected through shared memory")
+                stream = new_stream(metadata={})
+                streams[camera_id] = stream
+            if meta:
+                try:
+                    stream['metadata'] = orjson.loads(meta)
+                except orjson.JSONDecodeError:
+                    pass
+            publish_frame(stream, image, stream['metadata'])
+    finally:
+        if stream is not None:
+            if streams.get(camera_id) is stream:
                 del streams[camera_id]
+            stream['event'].set()
+        if shm is not None:
+            shm.close()
 
-@app.get("/active_cameras")
+@app.get("/active_cameras", response_class=ORJSONResponse)
 async def get_active_cameras():
     """Returns a list of currently active camera IDs."""
-    with stream_lock:
-        return {"cameras": list(streams.keys())}
+    return {"cameras": list(streams.keys())}
     
-def process_frame(jpeg_bytes, metadata, mode):
-    """Draws bounding boxes on frame based on mode."""
-    if not jpeg_bytes:
-        return None
-
-    # Decode
+def decode_jpeg(jpeg_bytes, scale=1):
+    """Decodes a JPEG to a BGR frame, optionally downscaled by `scale` during decode."""
+    if tj is not None:
+        try:
+            return tj.decode(jpeg_bytes, pixel_format=TJPF_BGR, scaling_factor=(1, scale) if scale > 1 else None)
+        except Exception:
+            return None
     nparr = np.frombuffer(jpeg_bytes, np.uint8)
-    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
-    if frame is None:
+    return cv2.imdecode(nparr, REDUCED_DECODE_FLAGS[scale])
+
+def encode_jpeg(frame):
+    """Encodes a BGR frame to JPEG bytes."""
+    if tj is not None:
+        return tj.encode(frame, quality=JPEG_QUALITY, jpeg_subsample=TJSAMP_420)
+    ret, buffer = cv2.imencode('.jpg', frame, CV2_JPEG_PARAMS)
+    if ret:
+        return buffer.tobytes()
+    return None
+
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+LABEL_SCALE = 0.5
+LINE_THICKNESS = 2
+
+@lru_cache(maxsize=1024)
+def label_glyph(text: str, color: Tuple[int, int, int]):
+    """
+    Rasterizes a label once and caches it as (tile, mask, baseline_y).
+    Labels only vary by prefix and a 2-digit confidence, so the cache stays small.
+    """
+    (w, h), baseline = cv2.getTextSize(text, LABEL_FONT, LABEL_SCALE, LINE_THICKNESS)
+    pad = LINE_THICKNESS
+    tile = np.zeros((h + baseline + 2 * pad, w + 2 * pad, 3), np.uint8)
+    cv2.putText(tile, text, (pad, pad + h), LABEL_FONT, LABEL_SCALE, color, LINE_THICKNESS)
+    mask = tile.any(axis=2)
+    return tile, mask, pad + h
+
+def draw_box(frame, x1, y1, x2, y2, color, t=LINE_THICKNESS):
+    """Draws a rectangle outline with four numpy slice assignments."""
+    h, w = frame.shape[:2]
+    x1, x2 = max(0, min(x1, x2)), min(w, max(x1, x2))
+    y1, y2 = max(0, min(y1, y2)), min(h, max(y1, y2))
+    if x1 >= x2 or y1 >= y2:
+        return
+    frame[y1:y1 + t, x1:x2] = color
+    frame[max(y1, y2 - t):y2, x1:x2] = color
+    frame[y1:y2, x1:x1 + t] = color
+    frame[y1:y2, max(x1, x2 - t):x2] = color
+
+def draw_label(frame, text, x, y, color):
+    """Copies a cached label glyph onto the frame with its baseline at (x, y)."""
+    tile, mask, baseline_y = label_glyph(text, color)
+    top, left = y - baseline_y, x - LINE_THICKNESS
+    h, w = frame.shape[:2]
+    # Clip the tile against the frame edges
+    t0, l0 = max(0, -top), max(0, -left)
+    t1, l1 = min(tile.shape[0], h - top), min(tile.shape[1], w - left)
+    if t0 >= t1 or l0 >= l1:
+        return
+    region = frame[top + t0:top + t1, left + l0:left + l1]
+    m = mask[t0:t1, l0:l1]
+    region[m] = tile[t0:t1, l0:l1][m]
+
+def process_frame(jpeg_bytes, metadata, mode, scale=1):
+    """Draws bounding boxes on frame based on mode. `scale` draws on a 1/scale size frame."""
+    if not jpeg_bytes:
         return None
 
-    # Draw based on mode
+    # Pick detections based on mode
     if mode == "fight":
         detections = metadata.get("fight", [])
         color = (0, 0, 255) # Red
@@ -95,43 +378,167 @@ def process_frame(jpeg_bytes, metadata, mode):
         color = (0, 255, 0)
         label_prefix = "Unknown"
 
+    # Nothing to draw: hand back the original JPEG without touching the codec
+    if not detections and scale == 1:
+        return jpeg_bytes
+
+    # Decode
+    frame = decode_jpeg(jpeg_bytes, scale)
+    
+    if frame is None:
+        return None
+
     # Common Drawing Logic
     for d in detections:
         bbox = d.get('bbox')
         conf = d.get('confidence', 0.0)
         if bbox:
-            x1, y1, x2, y2 = map(int, bbox)
-            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-            cv2.putText(frame, f"{label_prefix} {conf:.2f}", (x1, y1 - 10),
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+            x1, y1, x2, y2 = (int(v / scale) for v in bbox)
+            draw_box(frame, x1, y1, x2, y2, color)
+            draw_label(frame, f"{label_prefix} {conf:.2f}", x1, y1 - 10, color)
     
     # Re-encode
-    ret, buffer = cv2.imencode('.jpg', frame)
-    if ret:
-        return buffer.tobytes()
-    return None
+    return encode_jpeg(frame)
 
-def generate_frames(camera_id: str, mode: str = "fight"):
+async def watch_camera(camera_id: str, latest_only: bool = False):
     """
-    Generator that yields frames for a specific camera with requested visualization.
+    Async generator that yields each new Frame the camera pushes, oldest first.
+    With latest_only, frames superseded while the consumer was busy are skipped.
+    Waits for the camera to connect and follows it across reconnects.
     """
+    stream = None
+    last_seq = 0
     while True:
-        frame_data = None
-        metadata = {}
-        
-        with stream_lock:
-            data = streams.get(camera_id)
-            if data:
-                frame_data = data.get('image')
-                metadata = data.get('metadata', {})
-        
-        if frame_data:
-            processed_frame = process_frame(frame_data, metadata, mode)
-            if processed_frame:
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + processed_frame + b'\r\n')
-        
-        time.sleep(0.033) # 30 FPS
+        data = streams.get(camera_id)
+        if data is None:
+            # Camera not connected (yet)
+            await asyncio.sleep(0.1)
+            continue
+
+        if data is not stream:
+            # New (or reconnected) camera session
+            stream = data
+            last_seq = 0
+
+        pending = frames_since(stream, last_seq)
+        if not pending:
+            await stream['event'].wait()
+            continue
+
+        if latest_only:
+            pending = pending[-1:]
+        for frame in pending:
+            last_seq = frame[2]
+            yield frame
+
+# Frames with boxes burned in, produced once per (camera_id, mode) and shared by all viewers
+# Format: {(camera_id, mode, scale): {'frames': deque[Frame], 'seq': int, 'event': asyncio.Event, 'viewers': int, 'task': asyncio.Task}}
+processed_streams: Dict[Tuple[str, str, int], Dict[str, Any]] = {}
+
+async def produce_processed(camera_id: str, mode: str, scale: int, entry: Dict[str, Any]):
+    """Burns detections into each new camera frame for one mode."""
+    loop = asyncio.get_running_loop()
+    async for image, metadata, _, _ in watch_camera(camera_id, latest_only=True):
+        # Codec work releases the GIL, so run it off the event loop
+        processed_frame = await loop.run_in_executor(codec_executor, process_frame, image, metadata, mode, scale)
+        if processed_frame:
+            publish_frame(entry, processed_frame, metadata)
+
+def acquire_processed(camera_id: str, mode: str, scale: int) -> Dict[str, Any]:
+    """Registers a viewer for (camera_id, mode, scale), starting its producer if needed."""
+    key = (camera_id, mode, scale)
+    entry = processed_streams.get(key)
+    if entry is None:
+        entry = new_stream(viewers=0)
+        entry['task'] = asyncio.create_task(produce_processed(camera_id, mode, scale, entry))
+        processed_streams[key] = entry
+    entry['viewers'] += 1
+    return entry
+
+def release_processed(camera_id: str, mode: str, scale: int, entry: Dict[str, Any]):
+    """Unregisters a viewer, stopping the producer once nobody watches this mode."""
+    entry['viewers'] -= 1
+    if entry['viewers'] <= 0:
+        entry['task'].cancel()
+        key = (camera_id, mode, scale)
+        if processed_streams.get(key) is entry:
+            del processed_streams[key]
+
+def multipart_metadata(metadata: Dict[str, Any]) -> bytes:
+    body = orjson.dumps(metadata)
+    return multipart_header(b'application/json', len(body)) + body
+
+def reserve_viewer_slot():
+    """
+    Count an MJPEG viewer right away. Returns a release function that is safe to call
+    more than once, so both the generator and the response's background task can call it.
+    """
+    global mjpeg_viewers
+    mjpeg_viewers += 1
+    released = False
+
+    def release():
+        global mjpeg_viewers
+        nonlocal released
+        if not released:
+            released = True
+            mjpeg_viewers -= 1
+
+    return release
+
+async def generate_frames(request: Request, camera_id: str, release_viewer, mode: str = "fight", burn: bool = False, scale: int = 1, meta: bool = False):
+    """
+    Async generator that yields frames for a specific camera.
+    Only wakes up when a new frame is available, so stale frames are never re-sent.
+    Frames are passed through untouched; boxes are only drawn server-side when burn is set.
+    With meta set, each frame that has detections is followed by a JSON part carrying them.
+    Stops as soon as the viewer disconnects (or the response is cancelled) and releases
+    any shared producer it was holding, along with the viewer slot reserved by video_feed.
+    """
+    if not burn:
+        frames = watch_camera(camera_id)
+        try:
+            async for image, metadata, _, header in frames:
+                if await request.is_disconnected():
+                    break
+                if image:
+                    yield header
+                    yield image
+                    if meta and metadata.get(mode):
+                        yield multipart_metadata(metadata)
+        finally:
+            release_viewer()
+            await frames.aclose()
+        return
+
+    entry = acquire_processed(camera_id, mode, scale)
+    try:
+        last_seq = 0
+        while True:
+            pending = frames_since(entry, last_seq)
+            if not pending:
+                await entry['event'].wait()
+                continue
+            if await request.is_disconnected():
+                break
+            for image, _, seq, header in pending:
+                last_seq = seq
+                yield header
+                yield image
+    finally:
+        # Also runs on asyncio.CancelledError, so ghost viewers never keep a producer alive
+        release_viewer()
+        release_processed(camera_id, mode, scale, entry)
+
+async def generate_metadata(camera_id: str):
+    """
+    Async generator that emits the latest detections for a camera as Server-Sent Events.
+    """
+    last_metadata = None
+    async for _, metadata, _, _ in watch_camera(camera_id, latest_only=True):
+        if metadata is not last_metadata:
+            last_metadata = metadata
+            yield b"data: " + orjson.dumps(last_metadata) + b"\n\n"
 
 @app.get("/", response_class=HTMLResponse)
 async def index():
@@ -143,14 +550,61 @@ async def index():
                 body { font-family: sans-serif; text-align: center; padding: 20px; }
                 .container { max-width: 800px; margin: 0 auto; }
                 .camera-box { margin-bottom: 30px; border: 1px solid #ccc; padding: 10px; border-radius: 8px; }
-                img { max-width: 100%; border: 2px solid #333; }
+                .stream-wrap { position: relative; display: inline-block; }
+                img { max-width: 100%; border: 2px solid #333; display: block; }
+                canvas { position: absolute; left: 0; top: 0; pointer-events: none; }
                 .controls { margin-top: 10px; }
                 button { padding: 8px 16px; margin: 0 5px; cursor: pointer; }
             </style>
             <script>
+                const MODES = {
+                    fight: { color: 'rgb(255, 0, 0)', label: 'Fight' },
+                    fire: { color: 'rgb(255, 165, 0)', label: 'Fire' }
+                };
+                let currentMode = 'fight';
+                let lastMeta = {};
+
                 function setMode(mode) {
-                    document.getElementById('stream_img').src = "/video_feed/cam1?mode=" + mode + "&t=" + new Date().getTime();
+                    currentMode = mode;
+                    drawOverlay();
                 }
+
+                function drawOverlay() {
+                    const img = document.getElementById('stream_img');
+                    const canvas = document.getElementById('overlay');
+                    // Match the canvas to the displayed image (2px border offset)
+                    canvas.width = img.clientWidth;
+                    canvas.height = img.clientHeight;
+                    canvas.style.left = img.offsetLeft + img.clientLeft + 'px';
+                    canvas.style.top = img.offsetTop + img.clientTop + 'px';
+                    const ctx = canvas.getContext('2d');
+                    ctx.clearRect(0, 0, canvas.width, canvas.height);
+
+                    const style = MODES[currentMode];
+                    if (!style || !img.naturalWidth) return;
+
+                    const sx = canvas.width / img.naturalWidth;
+                    const sy = canvas.height / img.naturalHeight;
+                    ctx.strokeStyle = style.color;
+                    ctx.fillStyle = style.color;
+                    ctx.lineWidth = 2;
+                    ctx.font = '12px sans-serif';
+                    for (const d of (lastMeta[currentMode] || [])) {
+                        if (!d.bbox) continue;
+                        const [x1, y1, x2, y2] = d.bbox;
+                        ctx.strokeRect(x1 * sx, y1 * sy, (x2 - x1) * sx, (y2 - y1) * sy);
+                        ctx.fillText(style.label + ' ' + (d.confidence || 0).toFixed(2), x1 * sx, y1 * sy - 10);
+                    }
+                }
+
+                window.addEventListener('load', () => {
+                    const source = new EventSource('/meta/cam1');
+                    source.onmessage = (e) => {
+                        lastMeta = JSON.parse(e.data);
+                        drawOverlay();
+                    };
+                    window.addEventListener('resize', drawOverlay);
+                });
             </script>
         </head>
         <body>
@@ -165,7 +619,10 @@ async def index():
                 
                 <div class="camera-box">
                     <h3>Camera 1 (cam1)</h3>
-                    <img id="stream_img" src="/video_feed/cam1?mode=fight" alt="Waiting for stream..." />
+                    <div class="stream-wrap">
+                        <img id="stream_img" src="/video_feed/cam1" alt="Waiting for stream..." />
+                        <canvas id="overlay"></canvas>
+                    </div>
                 </div>
             </div>
         </body>
@@ -173,9 +630,90 @@ async def index():
     """
 
 @app.get("/video_feed/{camera_id}")
-async def video_feed(camera_id: str, mode: str = "fight"):
-    return StreamingResponse(generate_frames(camera_id, mode), media_type="multipart/x-mixed-replace; boundary=frame")
+async def video_feed(request: Request, camera_id: str, mode: str = "fight", burn: int = 0, scale: int = 1, meta: int = 0):
+    """
+    Raw MJPEG feed. Pass ?burn=1 to have boxes for `mode` drawn into the frames server-side,
+    and ?scale=2|4|8 to burn them into a downscaled frame (cheaper decode/encode).
+    Non-<img> clients can pass ?meta=1 to receive detections as application/json parts
+    in the same multipart stream instead.
+    """
+    if scale not in REDUCED_DECODE_FLAGS:
+        raise HTTPException(status_code=400, detail="scale must be one of 1, 2, 4, 8")
+    check_viewer_capacity()
+    # Reserve the slot now: the generator body only starts once the response is streaming, so
+    # counting there would let a burst of requests all pass the check against the old count.
+    # The background task releases it for responses whose body never starts.
+    release_viewer = reserve_viewer_slot()
+    try:
+        return StreamingResponse(
+            generate_frames(request, camera_id, release_viewer, mode, bool(burn), scale, bool(meta)),
+            media_type="multipart/x-mixed-replace; boundary=frame",
+            background=BackgroundTask(release_viewer)
+        )
+    except BaseException:
+        release_viewer()
+        raise
+
+def check_viewer_capacity():
+    if MAX_VIEWERS and mjpeg_viewers + len(peer_connections) >= MAX_VIEWERS:
+        raise HTTPException(status_code=503, detail="Too many viewers, try again later")
+
+if RTCPeerConnection is not None:
+    class CameraTrack(VideoStreamTrack):
+        """WebRTC video track fed with the latest frames a camera pushes."""
+        def __init__(self, camera_id: str):
+            super().__init__()
+            self.frames = watch_camera(camera_id, latest_only=True)
+            self.start = time.monotonic()
+
+        async def recv(self):
+            loop = asyncio.get_running_loop()
+            while True:
+                image, _, _, _ = await self.frames.__anext__()
+                frame = await loop.run_in_executor(codec_executor, decode_jpeg, image)
+                if frame is not None:
+                    break
+            video_frame = VideoFrame.from_ndarray(frame, format="bgr24")
+            # Timestamps follow arrival time, since cameras don't push at a fixed rate
+            video_frame.pts = int((time.monotonic() - self.start) * 90000)
+            video_frame.time_base = Fraction(1, 90000)
+            return video_frame
+
+class WebRTCOffer(BaseModel):
+    sdp: str
+    type: str
+
+@app.post("/offer/{camera_id}", response_class=ORJSONResponse)
+async def webrtc_offer(camera_id: str, offer: WebRTCOffer):
+    """
+    WebRTC alternative to /video_feed: exchanges an SDP offer for an answer carrying the
+    camera as an inter-frame coded video track, far fewer bytes per frame than MJPEG.
+    """
+    if RTCPeerConnection is None:
+        raise HTTPException(status_code=501, detail="WebRTC requires aiortc to be installed")
+    check_viewer_capacity()
+
+    pc = RTCPeerConnection()
+    peer_connections.add(pc)
+
+    @pc.on("connectionstatechange")
+    async def on_connection_state_change():
+        if pc.connectionState in ("failed", "closed"):
+            peer_connections.discard(pc)
+            await pc.close()
+
+    pc.addTrack(CameraTrack(camera_id))
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=offer.sdp, type=offer.type))
+    await pc.setLocalDescription(await pc.createAnswer())
+    return {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+
+@app.get("/meta/{camera_id}")
+async def meta_feed(camera_id: str):
+    """Detections for a camera as a Server-Sent Events stream, for client-side overlays."""
+    return StreamingResponse(generate_metadata(camera_id), media_type="text/event-stream")
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # uvloop is not available on Windows
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"
+    uvicorn.run(app, host="0.0.0.0", port=port, loop=loop, http="httptools", ws="websockets")
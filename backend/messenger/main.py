@@ -1,23 +1,108 @@
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 from contextlib import asynccontextmanager
+from typing import Optional, Set, Tuple
 import asyncio
+import base64
 import os
+import time
 import urllib.parse
 
+import orjson
 import uvicorn
 
+# Number of tabs used to send messages; the first is the docked status/QR tab.
+# WhatsApp Web keeps only one tab of a session active and shows "Use here" in the others,
+# so by default sends are serialized on that one tab. Raise only if that isn't a problem.
+POOL_SIZE = int(os.getenv("PAGE_POOL_SIZE", 1))
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# Selectors used while sending a message
+INPUT_SELECTOR = ", ".join([
+    '[data-testid="conversation-compose-box-input"]',
+    'div[contenteditable="true"][data-tab="10"]',
+    'footer div[contenteditable="true"]',
+    '#main footer div[contenteditable="true"]',
+    'div[role="textbox"]'
+])
+POPUP_SELECTOR = 'div[data-testid="popup-contents"]'
+
+# Selectors used to detect login state
+LOGGED_IN_SELECTOR = '#side, [data-testid="chat-list"], [data-testid="default-user"]'
+QR_SELECTOR = 'canvas, [data-testid="qrcode"]'
+SENT_SELECTOR = '[data-testid="msg-check"], [data-icon="msg-check"], [data-icon="msg-dblcheck"]'
+
 # Global browser and page instances
+# `page` serves /qr-image and /status; sends check out a tab from `page_pool`, which starts with `page`
 browser = None
 page = None
+page_pool = None
 playwright_instance = None
 
+# Latest login status, kept fresh by a single background poller
+STATUS_POLL_INTERVAL = 2.0
+latest_status: Optional[dict] = None
+status_subscribers: Set[asyncio.Queue] = set()
+
+# Last QR capture: (captured_at, png_bytes)
+QR_CACHE_TTL = 2.0
+qr_cache: Optional[Tuple[float, bytes]] = None
+
+
+async def new_page():
+    """Open a new tab with a realistic user agent"""
+    tab = await browser.new_page()
+    await tab.set_extra_http_headers({"User-Agent": USER_AGENT})
+    return tab
+
+
+async def open_chat(tab, phone: str, message: str):
+    """
+    Open the chat for `phone` with `message` pre-filled in the compose box.
+    
+    A tab already docked on WhatsApp Web follows a click-to-chat link in-app, which
+    skips reloading the whole web app. Falls back to a full /send navigation.
+    """
+    probe = message.strip().splitlines()[0][:20] if message.strip() else ""
+    if probe and tab.url.startswith("https://web.whatsapp.com") and await tab.query_selector(LOGGED_IN_SELECTOR):
+        await tab.evaluate(
+            """([phone, text]) => {
+                const link = document.createElement('a');
+                link.href = `https://api.whatsapp.com/send?phone=${encodeURIComponent(phone)}&text=${encodeURIComponent(text)}`;
+                document.body.appendChild(link);
+                link.click();
+                link.remove();
+            }""",
+            [phone, message]
+        )
+        # Only trust the switch once our draft shows up; the previous chat's compose box may still be there
+        try:
+            await tab.wait_for_function(
+                """([input, popup, probe]) => document.querySelector(popup) ||
+                    [...document.querySelectorAll(input)].some(el => el.innerText.includes(probe))""",
+                arg=[INPUT_SELECTOR, POPUP_SELECTOR, probe],
+                timeout=5000
+            )
+            return
+        except PlaywrightTimeoutError:
+            print(f"⚠️ In-app navigation to {phone} did not open the chat, reloading")
+    
+    url = f"https://web.whatsapp.com/send?phone={urllib.parse.quote(phone)}&text={urllib.parse.quote(message)}"
+    await tab.goto(url, wait_until="load", timeout=60000)
+    
+    # Wait for the chat to open (compose box) or for the invalid-number popup
+    try:
+        await tab.wait_for_selector(f'{INPUT_SELECTOR}, {POPUP_SELECTOR}', state="attached", timeout=15000)
+    except PlaywrightTimeoutError:
+        pass
+
 
 async def init_whatsapp():
     """Initialize WhatsApp Web browser session"""
-    global browser, page, playwright_instance
+    global browser, page, page_pool, playwright_instance
     
     playwright_instance = await async_playwright().start()
     
@@ -30,16 +115,20 @@ async def init_whatsapp():
         args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-gpu']
     )
     
-    page = await browser.new_page()
-    
-    # Set a realistic user agent
-    await page.set_extra_http_headers({
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-    })
+    page = await new_page()
     
     await page.goto("https://web.whatsapp.com", wait_until="load", timeout=60000)
     await asyncio.sleep(5)
     
+    # Tabs used for sending, starting with the docked page; concurrent requests queue for a tab.
+    # Each tab stays docked on web.whatsapp.com so sends can switch chats in-app.
+    page_pool = asyncio.Queue()
+    page_pool.put_nowait(page)
+    for _ in range(POOL_SIZE - 1):
+        tab = await new_page()
+        await tab.goto("https://web.whatsapp.com", wait_until="load", timeout=60000)
+        page_pool.put_nowait(tab)
+    
     print("✅ WhatsApp Web initialized. Open /qr to scan QR code.")
 
 
@@ -56,7 +145,9 @@ async def close_whatsapp():
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
     await init_whatsapp()
+    status_task = asyncio.create_task(watch_status())
     yield
+    status_task.cancel()
     await close_whatsapp()
 
 
@@ -142,15 +233,12 @@ async def get_qr_page():
                 document.getElementById('qr').src = '/qr-image?' + Date.now();
             }, 3000);
             
-            setInterval(async () => {
-                try {
-                    const res = await fetch('/status');
-                    const data = await res.json();
-                    const el = document.getElementById('status');
-                    el.textContent = data.message;
-                    el.className = data.status === 'logged_in' ? 'logged-in' : 'waiting';
-                } catch(e) {}
-            }, 2000);
+            new EventSource('/status/stream').onmessage = (e) => {
+                const data = JSON.parse(e.data);
+                const el = document.getElementById('status');
+                el.textContent = data.message;
+                el.className = data.status === 'logged_in' ? 'logged-in' : 'waiting';
+            };
         </script>
     </body>
     </html>
@@ -161,67 +249,96 @@ async def get_qr_page():
 @app.get("/qr-image")
 async def get_qr_image():
     """Returns the QR code image"""
-    global page
+    global qr_cache
     
     if not page:
         raise HTTPException(status_code=500, detail="Browser not initialized")
     
+    # Every open /qr page polls this, so serve recent captures from memory
+    if qr_cache and time.time() - qr_cache[0] < QR_CACHE_TTL:
+        return Response(content=qr_cache[1], media_type="image/png")
+    
     try:
-        await asyncio.sleep(0.5)
+        png_bytes = None
         
-        qr_selectors = ['canvas', '[data-testid="qrcode"]', 'div[data-ref] canvas']
+        try:
+            # Returns as soon as either the QR or the logged-in UI is present
+            await page.wait_for_selector(f"{LOGGED_IN_SELECTOR}, {QR_SELECTOR}", timeout=3000)
+            data_url = await page.evaluate("() => { const c = document.querySelector('canvas'); return c ? c.toDataURL('image/png') : null; }")
+            if data_url:
+                png_bytes = base64.b64decode(data_url.split(",", 1)[1])
+        except Exception:
+            pass
         
-        for selector in qr_selectors:
-            try:
-                qr_element = await page.wait_for_selector(selector, timeout=3000)
-                if qr_element:
-                    qr_path = os.path.join(os.getcwd(), "qr_code.png")
-                    await qr_element.screenshot(path=qr_path, type="png")
-                    return FileResponse(qr_path, media_type="image/png")
-            except:
-                continue
+        if png_bytes is None:
+            # Return full page screenshot if no QR found
+            png_bytes = await page.screenshot(full_page=True)
         
-        # Return full page screenshot if no QR found
-        screenshot_path = os.path.join(os.getcwd(), "page_screenshot.png")
-        await page.screenshot(path=screenshot_path, full_page=True)
-        return FileResponse(screenshot_path, media_type="image/png")
+        qr_cache = (time.time(), png_bytes)
+        return Response(content=png_bytes, media_type="image/png")
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/status")
+async def read_status():
+    """Check WhatsApp Web login status on the browser page"""
+    try:
+        # One wait covers both the logged-in UI and the QR code
+        try:
+            await page.wait_for_selector(f"{LOGGED_IN_SELECTOR}, {QR_SELECTOR}", timeout=3000)
+        except PlaywrightTimeoutError:
+            return {"status": "loading", "message": "⏳ Loading WhatsApp Web..."}
+        
+        if await page.query_selector(LOGGED_IN_SELECTOR):
+            return {"status": "logged_in", "message": "✅ WhatsApp Web is ready!"}
+        return {"status": "waiting_for_qr", "message": "⏳ Please scan QR code"}
+        
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+async def watch_status():
+    """Single background poller that pushes status changes to /status/stream clients"""
+    global latest_status
+    while True:
+        status = await read_status()
+        if status != latest_status:
+            latest_status = status
+            for queue in status_subscribers:
+                queue.put_nowait(status)
+        await asyncio.sleep(STATUS_POLL_INTERVAL)
+
+
+@app.get("/status", response_class=ORJSONResponse)
 async def check_status():
     """Check WhatsApp Web login status"""
-    global page
+    if not page:
+        raise HTTPException(status_code=500, detail="Browser not initialized")
     
+    # The background poller keeps this fresh; only hit the browser before its first run
+    return latest_status or await read_status()
+
+
+@app.get("/status/stream")
+async def status_stream():
+    """Login status as Server-Sent Events, pushed whenever it changes"""
     if not page:
         raise HTTPException(status_code=500, detail="Browser not initialized")
     
-    try:
-        logged_in_selectors = ['#side', '[data-testid="chat-list"]', '[data-testid="default-user"]']
-        
-        for selector in logged_in_selectors:
-            try:
-                element = await page.wait_for_selector(selector, timeout=2000)
-                if element:
-                    return {"status": "logged_in", "message": "✅ WhatsApp Web is ready!"}
-            except:
-                continue
-        
-        qr_selectors = ['canvas', '[data-testid="qrcode"]']
-        for selector in qr_selectors:
-            try:
-                qr = await page.wait_for_selector(selector, timeout=2000)
-                if qr:
-                    return {"status": "waiting_for_qr", "message": "⏳ Please scan QR code"}
-            except:
-                continue
-        
-        return {"status": "loading", "message": "⏳ Loading WhatsApp Web..."}
-        
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
+    async def events():
+        queue = asyncio.Queue()
+        status_subscribers.add(queue)
+        try:
+            if latest_status:
+                yield b"data: " + orjson.dumps(latest_status) + b"\n\n"
+            while True:
+                status = await queue.get()
+                yield b"data: " + orjson.dumps(status) + b"\n\n"
+        finally:
+            status_subscribers.discard(queue)
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 @app.post("/send-message")
@@ -232,23 +349,22 @@ async def send_whatsapp_message(request: MessageRequest):
     - **phone_no**: Phone number with country code (e.g., "919876543210" for India)
     - **message**: Message text to send
     """
-    global page
-    
-    if not page:
+    if page_pool is None:
         raise HTTPException(status_code=500, detail="Browser not initialized")
     
     phone = request.phone_no.lstrip("+")
     message = request.message
-    encoded_message = urllib.parse.quote(message)
+    # Digits only: the number goes into the click-to-chat URL's query string
+    if not (phone.isascii() and phone.isdigit()):
+        raise HTTPException(status_code=400, detail="phone_no must be digits with country code, e.g. 919876543210")
     
+    page = await page_pool.get()
     try:
-        url = f"https://web.whatsapp.com/send?phone={phone}&text={encoded_message}"
-        await page.goto(url, wait_until="load", timeout=60000)
-        await asyncio.sleep(8)
+        await open_chat(page, phone, message)
         
         # Check for invalid phone popup
         try:
-            invalid_popup = await page.query_selector('div[data-testid="popup-contents"]')
+            invalid_popup = await page.query_selector(POPUP_SELECTOR)
             if invalid_popup:
                 popup_text = await invalid_popup.inner_text()
                 if "invalid" in popup_text.lower() or "not on whatsapp" in popup_text.lower():
@@ -259,29 +375,18 @@ async def send_whatsapp_message(request: MessageRequest):
             pass
         
         # Find message input
-        input_selectors = [
-            '[data-testid="conversation-compose-box-input"]',
-            'div[contenteditable="true"][data-tab="10"]',
-            'footer div[contenteditable="true"]',
-            '#main footer div[contenteditable="true"]',
-            'div[role="textbox"]'
-        ]
-        
-        input_box = None
-        for selector in input_selectors:
-            try:
-                input_box = await page.wait_for_selector(selector, timeout=10000)
-                if input_box:
-                    break
-            except:
-                continue
+        input_box = await page.query_selector(INPUT_SELECTOR)
         
         if not input_box:
             await page.screenshot(path="error_screenshot.png")
             raise HTTPException(status_code=500, detail="Could not find message input")
         
+        # Wait until the compose box is editable
+        await page.wait_for_function("el => !el.matches(':disabled')", arg=input_box, timeout=5000)
         await input_box.click()
-        await asyncio.sleep(1)
+        
+        # Remember how many sent ticks are on screen so we can spot the new one
+        sent_before = len(await page.query_selector_all(SENT_SELECTOR))
         
         # Find and click send button
         send_selectors = ['[data-testid="send"]', 'span[data-icon="send"]', '[aria-label="Send"]']
@@ -300,7 +405,15 @@ async def send_whatsapp_message(request: MessageRequest):
         else:
             await page.keyboard.press("Enter")
         
-        await asyncio.sleep(2)
+        # Wait for the new message to get its sent/delivered tick
+        try:
+            await page.wait_for_function(
+                "([selector, count]) => document.querySelectorAll(selector).length > count",
+                arg=[SENT_SELECTOR, sent_before],
+                timeout=5000
+            )
+        except PlaywrightTimeoutError:
+            print(f"⚠️ Message to {phone} submitted but delivery tick not seen yet")
         
         return {"status": "success", "message": f"Message sent to {phone}"}
         
@@ -312,6 +425,8 @@ async def send_whatsapp_message(request: MessageRequest):
         except:
             pass
         raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
+    finally:
+        page_pool.put_nowait(page)
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8003))
@@ -0,0 +1,81 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_NAME = "crowd_shield.db"
+
+# Number of read-only connections kept open; writes share a single connection
+READER_POOL_SIZE = 4
+
+# Prepared statements kept per connection (sqlite3 defaults to 128)
+CACHED_STATEMENTS = 256
+
+# Applied to every pooled connection. journal_mode=WAL is persistent, so init_db sets it once.
+# (sqlite3.connect already installs a 5 s busy timeout.)
+PRAGMAS = [
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+]
+
+_readers = None
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _connect():
+    # Endpoints may run on the event loop or in the threadpool, so connections can't be thread-bound
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+    # return dicts
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def init_pool():
+    """Open the writer connection and the pool of reader connections."""
+    global _readers, _writer
+    _writer = _connect()
+    _readers = queue.Queue()
+    for _ in range(READER_POOL_SIZE):
+        _readers.put(_connect())
+
+
+def close_pool():
+    """Close every pooled connection."""
+    global _readers, _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+    if _readers is not None:
+        while not _readers.empty():
+            _readers.get_nowait().close()
+        _readers = None
+
+
+@contextmanager
+def get_ro_conn():
+    """Borrow a reader connection for the duration of the block."""
+    conn = _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
+
+
+@contextmanager
+def get_rw_conn():
+    """
+    Hold the writer connection for the duration of the block.
+    Commits when the block succeeds and rolls back if it raises.
+    """
+    with _writer_lock:
+        try:
+            yield _writer
+            _writer.commit()
+        except BaseException:
+            _writer.rollback()
+            raise
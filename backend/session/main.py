@@ -1,19 +1,36 @@
+import asyncio
 import sqlite3
 import uuid
+import io
 import os
 import shutil
-from typing import List
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Query
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+import httpx
 from dotenv import load_dotenv
 
+from db import init_pool, close_pool, get_ro_conn, get_rw_conn
+
 load_dotenv()
 
-app = FastAPI(title="Crowd Shield API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_pool()
+    init_db()
+    # Shared client for notifications and Firebase, so calls reuse kept-alive connections
+    app.state.http = httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=8))
+    yield
+    await app.state.http.aclose()
+    close_pool()
+
+app = FastAPI(title="Crowd Shield API", lifespan=lifespan)
 
 # Allow all origins (use with caution in production)
 app.add_middleware(
@@ -26,13 +43,58 @@ app.add_middleware(
 
 # Configuration
 UPLOAD_DIR = "uploaded_videos"
-DB_NAME = "crowd_shield.db"
 MESSENGER_API_URL = os.getenv("MESSENGER_API_URL", "http://localhost:8003/send-message")
 LIVESTREAM_SERVICE_URL = os.getenv("LIVESTREAM_SERVICE_URL", "http://localhost:8000")
 SELF_SERVICE_URL = os.getenv("SELF_SERVICE_URL", "http://localhost:8002")
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
 NOTIFY_PHONE_NUMBERS = os.getenv("NOTIFY_PHONE_NUMBERS", "").split(",")
 
+# Uploads from the same camera within this window update the existing session
+ACTIVE_SESSION_WINDOW = timedelta(minutes=30)
+
+# Response URLs are these prefixes plus the camera id / video filename
+LIVE_URL_PREFIX = f"{LIVESTREAM_SERVICE_URL}/video_feed/"
+VIDEO_URL_PREFIX = f"{SELF_SERVICE_URL}/videos/"
+
+# Columns every session read selects, in the order serialize_session unpacks them
+SESSION_COLUMNS = (
+    "session_id, notify_to, status, description, video_filename, "
+    "camera_id, latitude, longitude, severity, confidence"
+)
+
+# SQL used on request paths, built once so the text is identical on every call and hits
+# the connection's prepared-statement cache instead of being re-parsed
+SQL_SELECT_ACTIVE_FOR_CAMERA = "SELECT session_id FROM sessions WHERE camera_id = ? AND created_at >= ? ORDER BY created_at DESC LIMIT 1"
+SQL_UPDATE_ACTIVE_SESSION = f"UPDATE sessions SET video_filename = ?, description = ?, severity = ?, confidence = ? WHERE session_id = ? RETURNING {SESSION_COLUMNS}"
+SQL_INSERT_SESSION = "INSERT INTO sessions (session_id, video_filename, description, notify_to, status, camera_id, latitude, longitude, severity, confidence) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+SQL_UPDATE_STATUS = "UPDATE sessions SET status = ? WHERE session_id = ?"
+SQL_SELECT_ONE = f"SELECT {SESSION_COLUMNS} FROM sessions WHERE session_id = ?"
+# Newest first, keyset-paginated on (created_at, session_id) so deep pages stay index seeks
+SQL_SELECT_PAGE = f"SELECT {SESSION_COLUMNS} FROM sessions ORDER BY created_at DESC, session_id DESC LIMIT ?"
+SQL_SELECT_PAGE_AFTER = (
+    f"SELECT {SESSION_COLUMNS} FROM sessions "
+    "WHERE (created_at, session_id) < (SELECT created_at, session_id FROM sessions WHERE session_id = ?) "
+    "ORDER BY created_at DESC, session_id DESC LIMIT ?"
+)
+
+def serialize_session(row) -> dict:
+    """SessionResponse-shaped dict from a row (or tuple) in SESSION_COLUMNS order."""
+    session_id, notify_to, status, description, video_filename, camera_id, latitude, longitude, severity, confidence = row
+    camera_id = camera_id or "cam1"
+    return {
+        "session_id": session_id,
+        "notify_to": notify_to,
+        "status": status,
+        "description": description,
+        "live_url": LIVE_URL_PREFIX + camera_id,
+        "video_url": VIDEO_URL_PREFIX + video_filename if video_filename else "",
+        "camera_id": camera_id,
+        "latitude": latitude or "0.0",
+        "longitude": longitude or "0.0",
+        "severity": severity or "Normal",
+        "confidence": confidence or "Unknown"
+    }
+
 # Ensure upload directory exists
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
@@ -40,33 +102,96 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 app.mount("/videos", StaticFiles(directory="uploaded_videos"), name="videos")
 
 # Database Setup
+# Bump when adding a migration below; stored in the database as PRAGMA user_version
+SCHEMA_VERSION = 3
+
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # DROP existing table to reset schema (Requested by user)
-    cursor.execute("DROP TABLE IF EXISTS sessions")
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sessions (
-            session_id TEXT PRIMARY KEY,
-            video_path TEXT NOT NULL,
-            description TEXT,
-            notify_to TEXT,
-            status TEXT DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            camera_id TEXT,
-            latitude TEXT,
-            longitude TEXT,
-            severity TEXT,
-            confidence TEXT
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    with get_rw_conn() as conn:
+        cursor = conn.cursor()
+        
+        # WAL lets readers run alongside the writer and needs one fsync per commit instead of two.
+        # The mode is stored in the database file, so it survives restarts.
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                video_filename TEXT NOT NULL,
+                description TEXT,
+                notify_to TEXT,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                camera_id TEXT,
+                latitude TEXT,
+                longitude TEXT,
+                severity TEXT,
+                confidence TEXT
+            )
+        ''')
+        
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            # Databases created before the camera/location/alert columns existed
+            for column in ("camera_id", "latitude", "longitude", "severity", "confidence"):
+                try:
+                    cursor.execute(f"ALTER TABLE sessions ADD COLUMN {column} TEXT")
+                except sqlite3.OperationalError:
+                    # Column already exists
+                    pass
+        
+        if version < 2:
+            # Replaced by the covering index below
+            cursor.execute("DROP INDEX IF EXISTS idx_sessions_cam_created")
+        
+        if version < 3:
+            # Older databases stored os.path.join(UPLOAD_DIR, filename); keep just the filename
+            columns = [info[1] for info in cursor.execute("PRAGMA table_info(sessions)")]
+            if "video_path" in columns:
+                cursor.execute("ALTER TABLE sessions ADD COLUMN video_filename TEXT NOT NULL DEFAULT ''")
+                rows = cursor.execute("SELECT rowid, video_path FROM sessions").fetchall()
+                cursor.executemany(
+                    "UPDATE sessions SET video_filename = ? WHERE rowid = ?",
+                    [(os.path.basename(video_path or ""), rowid) for rowid, video_path in rows]
+                )
+                cursor.execute("ALTER TABLE sessions DROP COLUMN video_path")
+        
+        # Serves the per-camera "active session in the last 30 minutes" lookup on every upload.
+        # It carries session_id too, so the lookup is answered from the index alone.
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_cam_created_id ON sessions(camera_id, created_at DESC, session_id)")
+        # Serves the /sessions listing order
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_created_id ON sessions(created_at DESC, session_id DESC)")
+        
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
-init_db()
+# Chunk size for copying uploads that can't go through sendfile
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def save_upload(upload: UploadFile, path: str):
+    """
+    Write an uploaded file to `path`. Uploads Starlette has spooled to disk are copied
+    in the kernel with sendfile; small in-memory ones are copied in 1 MiB chunks.
+    """
+    src = upload.file
+    start = src.tell()
+    with open(path, "wb") as dst:
+        # Calling fileno() on a SpooledTemporaryFile would force an in-memory upload onto disk
+        if hasattr(os, "sendfile") and getattr(src, "_rolled", True):
+            try:
+                in_fd = src.fileno()
+                offset = start
+                size = os.fstat(in_fd).st_size
+                while offset < size:
+                    sent = os.sendfile(dst.fileno(), in_fd, offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return
+            except (OSError, AttributeError, io.UnsupportedOperation):
+                # e.g. platforms where sendfile only targets sockets; start over with a plain copy
+                dst.seek(0)
+                dst.truncate()
+                src.seek(start)
+        shutil.copyfileobj(src, dst, length=COPY_CHUNK_SIZE)
 
 # Pydantic models
 class SessionResponse(BaseModel):
@@ -88,6 +213,7 @@ class StatusUpdate(BaseModel):
 
 @app.post("/upload", response_model=List[SessionResponse])
 async def upload_video(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     description: str = Form(...),
     notify_to: str = Form(...),  # Comma-separated list of recipients
@@ -104,145 +230,106 @@ async def upload_video(
     try:
         # Save the video file
         file_extension = os.path.splitext(file.filename)[1]
-        video_filename = f"{uuid.uuid4()}{file_extension}"
+        video_filename = f"{uuid.uuid4().hex}{file_extension}"
         video_path = os.path.join(UPLOAD_DIR, video_filename)
         
-        with open(video_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        save_upload(file, video_path)
         
         # Parse recipients
         recipients = [r.strip() for r in notify_to.split(",") if r.strip()]
         
         created_sessions = []
-        conn = sqlite3.connect(DB_NAME)
-        # return dicts
-        conn.row_factory = sqlite3.Row 
-        cursor = conn.cursor()
-        
-        # Check for active session for this camera within last 30 minutes
-        cursor.execute(
-            "SELECT * FROM sessions WHERE camera_id = ? AND created_at >= datetime('now', '-30 minutes') ORDER BY created_at DESC LIMIT 1",
-            (camera_id,)
-        )
-        active_session = cursor.fetchone()
-        
-        if active_session:
-            # Update existing session
-            session_id = active_session['session_id']
-            print(f"Updating active session {session_id} for camera {camera_id}")
+        with get_rw_conn() as conn:
+            cursor = conn.cursor()
             
-            cursor.execute(
-                "UPDATE sessions SET video_path = ?, description = ?, severity = ?, confidence = ? WHERE session_id = ?",
-                (video_path, description, severity, confidence, session_id)
-            )
+            # Take the write lock up front so the lookup and the insert/update are one transaction
+            conn.execute("BEGIN IMMEDIATE")
             
-            # Fetch updated session details to return
-            # We construct the response object based on the updated info and existing session data
-            session_data = dict(active_session)
-            session_data['video_path'] = video_path
-            session_data['description'] = description
-            session_data['severity'] = severity
-            session_data['confidence'] = confidence
+            # Check for active session for this camera within last 30 minutes.
+            # The cutoff is bound as a literal in created_at's format (CURRENT_TIMESTAMP is UTC).
+            cutoff = (datetime.now(timezone.utc) - ACTIVE_SESSION_WINDOW).strftime("%Y-%m-%d %H:%M:%S")
+            cursor.execute(SQL_SELECT_ACTIVE_FOR_CAMERA, (camera_id, cutoff))
+            active_session = cursor.fetchone()
             
-            # Helper to format response
-            def format_response(row_dict):
-                cam_id = row_dict.get('camera_id') or "cam1"
-                vid_path = row_dict.get('video_path')
-                vid_filename = os.path.basename(vid_path) if vid_path else ""
+            if active_session:
+                # Update existing session
+                session_id = active_session['session_id']
+                print(f"Updating active session {session_id} for camera {camera_id}")
                 
-                return {
-                    "session_id": row_dict['session_id'],
-                    "notify_to": row_dict['notify_to'],
-                    "status": row_dict['status'],
-                    "description": row_dict['description'],
-                    "live_url": f"{LIVESTREAM_SERVICE_URL}/video_feed/{cam_id}",
-                    "video_url": f"{SELF_SERVICE_URL}/videos/{vid_filename}" if vid_filename else "",
-                    "camera_id": cam_id,
-                    "latitude": row_dict.get('latitude') or "0.0",
-                    "longitude": row_dict.get('longitude') or "0.0",
-                    "severity": row_dict.get('severity') or "Normal",
-                    "confidence": row_dict.get('confidence') or "Unknown"
-                }
-
-            created_sessions.append(format_response(session_data))
-            
-            # Commit changes
-            conn.commit()
-            conn.close()
-            
+                # RETURNING hands back the updated row, so no second query (or stale copy) is needed
+                cursor.execute(SQL_UPDATE_ACTIVE_SESSION, (video_filename, description, severity, confidence, session_id))
+                created_sessions.append(serialize_session(cursor.fetchone()))
+                
+            else:
+                # Create NEW session
+                rows = []
+                for recipient in recipients:
+                    session_id = uuid.uuid4().hex
+                    rows.append((session_id, video_filename, description, recipient, "pending", camera_id, latitude, longitude, severity, confidence))
+                    created_sessions.append(serialize_session((
+                        session_id, recipient, "pending", description, video_filename,
+                        camera_id, latitude, longitude, severity, confidence
+                    )))
+                
+                # One prepared statement for every recipient, committed together
+                cursor.executemany(SQL_INSERT_SESSION, rows)
+        
+        if active_session:
             # SKIP Notification for updates
             print(f"Skipping notification for updated session {session_id}")
             
-        else:
-            # Create NEW session
-            for recipient in recipients:
-                session_id = str(uuid.uuid4())
-                cursor.execute(
-                    "INSERT INTO sessions (session_id, video_path, description, notify_to, status, camera_id, latitude, longitude, severity, confidence) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (session_id, video_path, description, recipient, "pending", camera_id, latitude, longitude, severity, confidence)
-                )
-                created_sessions.append({
-                    "session_id": session_id,
-                    "notify_to": recipient,
-                    "status": "pending",
-                    "description": description,
-                    "live_url": f"{LIVESTREAM_SERVICE_URL}/video_feed/{camera_id}",
-                    "video_url": f"{SELF_SERVICE_URL}/videos/{video_filename}",
-                    "camera_id": camera_id,
-                    "latitude": latitude,
-                    "longitude": longitude,
-                    "severity": severity,
-                    "confidence": confidence
-                })
-                
-            conn.commit()
-            conn.close()
-            
-            # Send WhatsApp notifications (ONLY for new sessions)
-            for phone in NOTIFY_PHONE_NUMBERS:
-                phone = phone.strip()
-                if phone:
-                    try:
-                        session_url = f"{FRONTEND_URL}/session/{created_sessions[0]['session_id']}"
-                        desc = created_sessions[0]['description']
-                        message_text = f"🚨 {desc}\nSeverity: {severity}\nConfidence: {confidence}\n{session_url}"
-                        requests.post(MESSENGER_API_URL, json={
-                            "phone_no": phone,
-                            "message": message_text
-                        })
-                        print(f"Notification sent to {phone}")
-                    except Exception as e:
-                        print(f"Failed to send notification to {phone}: {e}")
+        elif created_sessions:
+            # Send WhatsApp notifications (ONLY for new sessions) after the response has gone out
+            background_tasks.add_task(send_notifications, created_sessions[0]['session_id'], description, severity, confidence)
         
         return created_sessions
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Messenger sends drive a real browser and can take a while
+NOTIFY_TIMEOUT = 60.0
+
+async def send_notifications(session_id: str, description: str, severity: str, confidence: str):
+    """Send the WhatsApp alert for a new session to every number in NOTIFY_PHONE_NUMBERS, in parallel."""
+    phones = [phone.strip() for phone in NOTIFY_PHONE_NUMBERS if phone.strip()]
+    session_url = f"{FRONTEND_URL}/session/{session_id}"
+    message_text = f"🚨 {description}\nSeverity: {severity}\nConfidence: {confidence}\n{session_url}"
+    
+    results = await asyncio.gather(*(
+        app.state.http.post(MESSENGER_API_URL, json={
+            "phone_no": phone,
+            "message": message_text
+        }, timeout=NOTIFY_TIMEOUT)
+        for phone in phones
+    ), return_exceptions=True)
+    
+    for phone, result in zip(phones, results):
+        if isinstance(result, Exception):
+            print(f"Failed to send notification to {phone}: {result}")
+        else:
+            print(f"Notification sent to {phone}")
+
 # Firebase Configuration
 FIREBASE_HOST = os.getenv("FIREBASE_HOST", "crowdshield-5d9bd-default-rtdb.asia-southeast1.firebasedatabase.app")
 FIREBASE_AUTH = os.getenv("FIREBASE_AUTH", "GFKbvVRU3A4camE35uFRskCACmNf1Kvi5VHOsOTd")
 FIREBASE_URL = f"https://{FIREBASE_HOST}/led/state.json?auth={FIREBASE_AUTH}"
 
+def set_session_status(session_id: str, status: str):
+    """Set a session's status in a single UPDATE; 404 if no such session."""
+    with get_rw_conn() as conn:
+        cursor = conn.execute(SQL_UPDATE_STATUS, (status, session_id))
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=404, detail="Session not found")
+
 @app.post("/session/{session_id}/approve")
 async def approve_session(session_id: str):
     """Approve a specific session and trigger Firebase event."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT session_id FROM sessions WHERE session_id = ?", (session_id,))
- 
-    if not cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Session not found")
-        
-    cursor.execute("UPDATE sessions SET status = 'approved' WHERE session_id = ?", (session_id,))
-    conn.commit()
-    conn.close()
+    set_session_status(session_id, "approved")
 
     # Trigger Firebase
     try:
-        response = requests.put(FIREBASE_URL, json=1)
+        response = await app.state.http.put(FIREBASE_URL, json=1, timeout=10.0)
         if response.status_code == 200:
             print(f"Firebase updated successfully for session {session_id}")
         else:
@@ -255,79 +342,43 @@ async def approve_session(session_id: str):
 @app.post("/session/{session_id}/reject")
 async def reject_session(session_id: str):
     """Reject a specific session."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT session_id FROM sessions WHERE session_id = ?", (session_id,))
-    if not cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Session not found")
-        
-    cursor.execute("UPDATE sessions SET status = 'rejected' WHERE session_id = ?", (session_id,))
-    conn.commit()
-    conn.close()
+    set_session_status(session_id, "rejected")
     return {"session_id": session_id, "status": "rejected"}
 
 @app.get("/session/{session_id}", response_model=SessionResponse)
 async def get_session(session_id: str):
     """Get details of a specific session."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT session_id, notify_to, status, description, video_path, camera_id, latitude, longitude, severity, confidence FROM sessions WHERE session_id = ?", (session_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with get_ro_conn() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(SQL_SELECT_ONE, (session_id,))
+        row = cursor.fetchone()
     
     if not row:
         raise HTTPException(status_code=404, detail="Session not found")
-    cam_id = row['camera_id'] or "cam1"
-    vid_path = row['video_path']
-    vid_filename = os.path.basename(vid_path) if vid_path else ""
-    
-    return {
-        "session_id": row['session_id'],
-        "notify_to": row['notify_to'],
-        "status": row['status'],
-        "description": row['description'],
-        "live_url": f"{LIVESTREAM_SERVICE_URL}/video_feed/{cam_id}",
-        "video_url": f"{SELF_SERVICE_URL}/videos/{vid_filename}" if vid_filename else "",
-        "camera_id": cam_id,
-        "latitude": row['latitude'] or "0.0",
-        "longitude": row['longitude'] or "0.0",
-        "severity": row['severity'] or "Normal",
-        "confidence": row['confidence'] or "Unknown"
-    }
+    return serialize_session(row)
 
-@app.get("/sessions", response_model=List[SessionResponse])
-async def list_sessions():
-    """List all sessions."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT session_id, notify_to, status, description, video_path, camera_id, latitude, longitude, severity, confidence FROM sessions")
-    rows = cursor.fetchall()
-    conn.close()
-    
-    results = []
-    for row in rows:
-        d = dict(row)
-        cam_id = d.get('camera_id') or "cam1"
-        d['live_url'] = f"{LIVESTREAM_SERVICE_URL}/video_feed/{cam_id}"
-        d['camera_id'] = cam_id
-        d['latitude'] = d.get('latitude') or "0.0"
-        d['longitude'] = d.get('longitude') or "0.0"
-        d['severity'] = d.get('severity') or "Normal"
-        d['confidence'] = d.get('confidence') or "Unknown"
-        
-        if d.get('video_path'):
-            filename = os.path.basename(d['video_path'])
-            d['video_url'] = f"{SELF_SERVICE_URL}/videos/{filename}"
+@app.get("/sessions", response_model=List[SessionResponse], response_class=ORJSONResponse)
+async def list_sessions(
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    after: Optional[str] = None
+):
+    """
+    List sessions, newest first. Without `limit` every session is returned.
+    Pass the last session_id of a page as `after` to get the next page.
+    """
+    # LIMIT -1 is SQLite for "no limit"
+    if limit is None:
+        limit = -1
+    with get_ro_conn() as conn:
+        cursor = conn.cursor()
+        if after:
+            cursor.execute(SQL_SELECT_PAGE_AFTER, (after, limit))
         else:
-             d['video_url'] = ""
-        results.append(d)
-
-    return results
+            cursor.execute(SQL_SELECT_PAGE, (limit,))
+        rows = cursor.fetchall()
+    
+    return [serialize_session(row) for row in rows]
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8002)
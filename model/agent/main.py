@@ -1,14 +1,20 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form
 import uvicorn
+import asyncio
+import aiofiles
 import shutil
+import uuid
 from pathlib import Path
 import os
 import cv2
 import google.generativeai as genai
 from dotenv import load_dotenv
-from PIL import Image
 import io
-import requests
+import httpx
+import orjson
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 load_dotenv()
 
@@ -19,81 +25,282 @@ if not GEMINI_API_KEY:
 
 genai.configure(api_key=GEMINI_API_KEY)
 
-app = FastAPI(title="Agent API")
+# Frames from concurrent /agent requests are classified together in one Gemini call
+BATCH_WINDOW = 0.5
+BATCH_MAX_FRAMES = 8
+gemini_queue = asyncio.Queue()
+# Keeps in-flight batch tasks referenced until they finish
+pending_batches = set()
+
+CLASSIFY_PROMPT = "Analyze this image for safety. Classify it as Fire, Violence or Normal (safe).\nAlso provide a Severity (Critical/Warning/Informational) and a Confidence score (0-100)."
+BATCH_PROMPT = "\nYou are given {count} independent frames, each labeled \"Frame N:\". Classify every frame separately and return one result per frame, in frame order."
+
+# Structured output: Gemini returns JSON matching these schemas instead of free text
+RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "event_type": {"type": "string", "enum": ["Fire", "Violence", "Normal"]},
+        "severity": {"type": "string"},
+        "confidence": {"type": "integer"}
+    },
+    "required": ["event_type", "severity", "confidence"]
+}
+single_model = genai.GenerativeModel('gemini-2.5-flash', generation_config={
+    "response_mime_type": "application/json",
+    "response_schema": RESULT_SCHEMA
+})
+batch_model = genai.GenerativeModel('gemini-2.5-flash', generation_config={
+    "response_mime_type": "application/json",
+    "response_schema": {"type": "array", "items": RESULT_SCHEMA}
+})
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared keep-alive connection pool for Crowd Shield uploads
+    app.state.http = httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=16))
+    worker = asyncio.create_task(batch_worker())
+    yield
+    worker.cancel()
+    await app.state.http.aclose()
+
+app = FastAPI(title="Agent API", lifespan=lifespan)
+
+# Gemini requests allowed in flight at once; match it to the API tier's rate limit
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", 8))
+gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# Gemini errors worth retrying: rate limiting (429) and server-side failures
+RETRYABLE_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+# Uploading a clip can take a while on slow links
+UPLOAD_TIMEOUT = 60.0
 
 UPLOAD_DIR = Path("received_videos")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-def process_video_with_gemini(video_path: Path):
+# Uploads wait here until Gemini has judged them; only alerts are moved into UPLOAD_DIR.
+# Set to a RAM disk such as /dev/shm so videos judged normal never touch the disk
+# (Docker's default /dev/shm is only 64 MB; uploads that don't fit are staged in UPLOAD_DIR).
+STAGING_DIR = Path(os.getenv("AGENT_STAGING_DIR", str(UPLOAD_DIR)))
+
+# Read size when streaming uploads to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# The frame is sent to Gemini as JPEG bytes, skipping the RGB/PIL round-trip
+JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 80]
+# Gemini downscales images itself, so larger frames only cost upload time and memory
+MAX_IMAGE_SIZE = (768, 432)
+
+def sendfile_upload(upload: UploadFile, path: Path):
     """
-    Extracts a frame from the video and asks Gemini if a person is present.
+    Copies an upload Starlette has spooled to disk into `path` in the kernel.
+    Returns False if sendfile can't be used, leaving the upload where it started.
+    """
+    src = upload.file
+    start = src.tell()
+    try:
+        in_fd = src.fileno()
+        with open(path, "wb") as dst:
+            offset = start
+            size = os.fstat(in_fd).st_size
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), in_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        return True
+    except (OSError, AttributeError, io.UnsupportedOperation):
+        # e.g. platforms where sendfile only targets sockets
+        src.seek(start)
+        return False
+
+async def save_upload(upload: UploadFile, path: Path):
+    """
+    Writes an uploaded file to `path`: with sendfile when it is already on disk,
+    otherwise in UPLOAD_CHUNK_SIZE chunks through aiofiles.
+    """
+    # Calling fileno() on a SpooledTemporaryFile would force an in-memory upload onto disk
+    if hasattr(os, "sendfile") and getattr(upload.file, "_rolled", True):
+        if await asyncio.to_thread(sendfile_upload, upload, path):
+            return
+    async with aiofiles.open(path, "wb") as buffer:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            await buffer.write(chunk)
+
+def encode_frame(frame):
+    """
+    Shrinks the frame to fit MAX_IMAGE_SIZE (keeping its aspect ratio) and encodes it as JPEG.
+    Returns the JPEG bytes, or None if encoding fails.
+    """
+    h, w = frame.shape[:2]
+    scale = min(MAX_IMAGE_SIZE[0] / w, MAX_IMAGE_SIZE[1] / h)
+    if scale < 1:
+        frame = cv2.resize(frame, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+    ok, buf = cv2.imencode('.jpg', frame, JPEG_PARAMS)
+    return buf.tobytes() if ok else None
+
+def extract_middle_frame(video_path: Path):
+    """
+    Decodes the middle frame of the video. Returns None if it can't be read.
     """
-    print(f"Processing video: {video_path}")
     cap = cv2.VideoCapture(str(video_path))
     if not cap.isOpened():
         print("Error opening video file")
-        return False
+        return None
 
     # Get total frames and pick a middle frame to ensure we see the scene
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     middle_frame_index = max(0, total_frames // 2)
-    cap.set(cv2.CAP_PROP_POS_FRAMES, middle_frame_index)
-    
-    ret, frame = cap.read()
+
+    # Seeking is only keyframe-accurate on some codecs, so land at or before the
+    # middle frame and grab() forward from there; grab() skips the BGR conversion
+    # for every discarded frame and only the middle one is retrieved
+    if not cap.set(cv2.CAP_PROP_POS_FRAMES, middle_frame_index) or cap.get(cv2.CAP_PROP_POS_FRAMES) > middle_frame_index:
+        cap.release()
+        cap = cv2.VideoCapture(str(video_path))
+    position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+    ret = True
+    for _ in range(position, middle_frame_index + 1):
+        if not cap.grab():
+            ret = False
+            break
+    frame = cap.retrieve()[1] if ret else None
     cap.release()
     
     if not ret:
         print("Error reading frame from video")
+    return frame
+
+async def process_video_with_gemini(video_path: Path):
+    """
+    Extracts a frame from the video and asks Gemini if a person is present.
+    """
+    print(f"Processing video: {video_path}")
+    # Decoding is blocking, keep it off the event loop
+    frame = await asyncio.to_thread(extract_middle_frame, video_path)
+    if frame is None:
+        return False
+
+    jpeg = await asyncio.to_thread(encode_frame, frame)
+    # Drop the decoded frame now rather than holding it while waiting on Gemini
+    del frame
+    if jpeg is None:
+        print("Error encoding frame")
         return False
+    image_part = {"mime_type": "image/jpeg", "data": jpeg}
+
+    # Queue the frame for the batch worker and wait for its verdict
+    future = asyncio.get_running_loop().create_future()
+    await gemini_queue.put((image_part, future))
+    return await future
 
-    # Convert BGR (OpenCV) to RGB (PIL)
-    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    pil_image = Image.fromarray(rgb_frame)
+def to_result(item: dict):
+    """
+    Converts one structured classification into the event result used by the endpoint.
+    """
+    return {
+        "event_type": item["event_type"],
+        "severity": item["severity"],
+        "confidence": f"{item['confidence']}%"
+    }
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(min=0.5, max=8),
+       retry=retry_if_exception_type(RETRYABLE_GEMINI_ERRORS), reraise=True)
+async def generate(model, parts: list):
+    """
+    Calls Gemini, at most GEMINI_CONCURRENCY at a time, retrying with backoff on 429/5xx.
+    """
+    # Backoff happens outside the semaphore so waiting retries don't hold a slot
+    async with gemini_semaphore:
+        return await model.generate_content_async(parts)
 
+async def classify_frames(image_parts: list):
+    """
+    Sends one or more frames to Gemini in a single request and returns one result per frame.
+    """
     try:
-        print("Sending frame to Gemini for validation...")
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content([
-            "Analyze this image for safety. Classify it as one of the following:\n0 - Fire\n1 - Violence\n2 - Normal/Safe\nAlso provide a Severity (Critical/Warning/Informational) and a Confidence score (0-100%).\nReturn the response in this format:\nClass: [0/1/2]\nSeverity: [Severity]\nConfidence: [Score%]",
-            pil_image
-        ])
-        
-        content = response.text.strip()
-        print(f"Gemini response: {content}")
+        print(f"Sending {len(image_parts)} frame(s) to Gemini for validation...")
+        if len(image_parts) == 1:
+            response = await generate(single_model, [CLASSIFY_PROMPT, image_parts[0]])
+            print(f"Gemini response: {response.text}")
+            return [to_result(orjson.loads(response.text))]
         
-        # Parse response
-        event_type = "Normal"
-        severity = "Normal"
-        confidence = "0%"
+        parts = [CLASSIFY_PROMPT + BATCH_PROMPT.format(count=len(image_parts))]
+        for i, image_part in enumerate(image_parts, start=1):
+            parts += [f"Frame {i}:", image_part]
+        response = await generate(batch_model, parts)
+        print(f"Gemini response: {response.text}")
         
-        lines = content.split('\n')
-        for line in lines:
-            if "Class:" in line:
-                if "0" in line: event_type = "Fire"
-                elif "1" in line: event_type = "Violence"
-                else: event_type = "Normal"
-            if "Severity:" in line:
-                severity = line.split("Severity:")[1].strip()
-            if "Confidence:" in line:
-                confidence = line.split("Confidence:")[1].strip()
-        
-        return {
-            "event_type": event_type,
-            "severity": severity,
-            "confidence": confidence
-        }
+        # One item per frame, in order; a frame Gemini skipped counts as Normal
+        items = orjson.loads(response.text)
+        results = [to_result(item) for item in items[:len(image_parts)]]
+        results += [{"event_type": "Normal", "severity": "Normal", "confidence": "0%"} for _ in image_parts[len(results):]]
+        return results
 
     except Exception as e:
         print(f"Gemini error: {e}")
         print("WARNING: Using dummy data for session due to API error.")
         # Fallback to dummy data as requested
-        return {
+        return [{
             "event_type": "Violence",
             "severity": "Critical",
             "confidence": "Simulated (API Limit)"
-        }
+        } for _ in image_parts]
+
+async def flush_batch(batch: list):
+    results = await classify_frames([image_part for image_part, _ in batch])
+    for (_, future), result in zip(batch, results):
+        if not future.done():
+            future.set_result(result)
+
+async def batch_worker():
+    """
+    Collects queued frames for up to BATCH_WINDOW seconds (or BATCH_MAX_FRAMES frames)
+    and classifies them with a single Gemini request.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await gemini_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW
+        while len(batch) < BATCH_MAX_FRAMES:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(gemini_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Don't hold up the next batch while this one is in flight
+        task = asyncio.create_task(flush_batch(batch))
+        pending_batches.add(task)
+        task.add_done_callback(pending_batches.discard)
+
+def is_retryable_upload_error(e: BaseException):
+    """Connection failures, 429 and 5xx responses from the Crowd Shield API."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
 
-def handle_event(video_path: Path, event_data: dict, camera_id: str, latitude: str, longitude: str):
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(min=0.5, max=8),
+       retry=retry_if_exception(is_retryable_upload_error), reraise=True)
+async def post_session(url: str, video_path: Path, data: dict):
+    """
+    Uploads the video to the Crowd Shield API. The file is reopened on every attempt.
+    """
+    with open(video_path, 'rb') as f:
+        files = {'file': (video_path.name, f, 'video/mp4')}
+        response = await app.state.http.post(url, files=files, data=data, timeout=UPLOAD_TIMEOUT)
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
+    return response
+
+async def handle_event(video_path: Path, event_data: dict, camera_id: str, latitude: str, longitude: str):
     """
     Sends the video to the Crowd Shield API to create a session for the event.
     """
@@ -107,27 +314,36 @@ def handle_event(video_path: Path, event_data: dict, camera_id: str, latitude: s
     description = f"Security Alert: {event_type} detected!"
     
     try:
-        with open(video_path, 'rb') as f:
-            files = {'file': (video_path.name, f, 'video/mp4')}
-            data = {
-                'description': description,
-                'notify_to': 'admin,security',
-                'camera_id': camera_id,
-                'latitude': latitude,
-                'longitude': longitude,
-                'severity': severity,
-                'confidence': confidence
-            }
-            response = requests.post(crowd_shield_url, files=files, data=data)
+        data = {
+            'description': description,
+            'notify_to': 'admin,security',
+            'camera_id': camera_id,
+            'latitude': latitude,
+            'longitude': longitude,
+            'severity': severity,
+            'confidence': confidence
+        }
+        response = await post_session(crowd_shield_url, video_path, data)
+        
+        if response.status_code == 200:
+            print(f"Successfully created session: {response.json()}")
+        else:
+            print(f"Failed to create session. Status: {response.status_code}, Response: {response.text}")
             
-            if response.status_code == 200:
-                print(f"Successfully created session: {response.json()}")
-            else:
-                print(f"Failed to create session. Status: {response.status_code}, Response: {response.text}")
-                
     except Exception as e:
         print(f"Error sending to Crowd Shield API: {e}")
 
+def staging_dir_for(size):
+    """STAGING_DIR if it has room for an upload of `size` bytes (None if unknown), else UPLOAD_DIR."""
+    if STAGING_DIR == UPLOAD_DIR or size is None:
+        return UPLOAD_DIR
+    try:
+        if shutil.disk_usage(STAGING_DIR).free > size:
+            return STAGING_DIR
+    except OSError:
+        pass
+    return UPLOAD_DIR
+
 @app.post("/agent")
 async def agent_endpoint(
     file: UploadFile = File(...),
@@ -135,30 +351,43 @@ async def agent_endpoint(
     latitude: str = Form("0.0"),
     longitude: str = Form("0.0")
 ):
+    # Never let the client pick a path outside UPLOAD_DIR
+    filename = Path(file.filename or "").name
+    if not filename:
+        raise HTTPException(status_code=400, detail="Missing filename")
+    
+    staged_path = staging_dir_for(file.size) / f"agent_{uuid.uuid4().hex}{Path(filename).suffix}"
     try:
-        file_path = UPLOAD_DIR / file.filename
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        await save_upload(file, staged_path)
         
-        print(f"Received video: {file.filename} from {camera_id} at {latitude},{longitude}")
+        print(f"Received video: {filename} from {camera_id} at {latitude},{longitude}")
         
         # Analyze video with Gemini
-        result = process_video_with_gemini(file_path)
+        result = await process_video_with_gemini(staged_path)
+        if not result:
+            raise HTTPException(status_code=400, detail="Could not read a frame from the uploaded video")
         event_result = result['event_type']
         
         if event_result == "Fire" or event_result == "Violence":
-            handle_event(file_path, result, camera_id, latitude, longitude)
+            file_path = UPLOAD_DIR / filename
+            # A rename when both are on the same filesystem, otherwise the only write to disk
+            await asyncio.to_thread(shutil.move, staged_path, file_path)
+            await handle_event(file_path, result, camera_id, latitude, longitude)
         else:
             print(f"Event judged as {event_result} (Safe/Normal). No action taken.")
         
         return {
-            "filename": file.filename, 
+            "filename": filename, 
             "status": "processed", 
             "event_detected": event_result,
             "details": result
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        staged_path.unlink(missing_ok=True)
 
 @app.get("/")
 def root():
@@ -2,8 +2,10 @@
 import argparse
 import sys
 import time
-import requests
-from collections import deque
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from uploader import submit_upload
 from pathlib import Path
 
 def main():
@@ -21,6 +23,10 @@ def main():
 	parser.add_argument("--tm-model", default="converted_keras/keras_model.h5", help="Path to TM .h5 model")
 	parser.add_argument("--tm-labels", default="converted_keras/labels.txt", help="Path to TM labels file")
 	parser.add_argument("--device-index", type=int, default=1, help="Camera device index (default: 1, often OBS Virtual Camera)")
+	parser.add_argument("--clip-encoder", default=os.getenv("CLIP_ENCODER", "h264_nvenc"), help="ffmpeg video encoder for saved clips, e.g. h264_nvenc, h264_vaapi, libx264 (default: h264_nvenc)")
+	parser.add_argument("--detect-every", type=int, default=3, help="Classify every Nth frame; frames in between reuse the last result (default: 3)")
+	parser.add_argument("--opencl", action="store_true", help="Run the frame preprocessing through OpenCV's OpenCL T-API (UMat)")
+	parser.add_argument("--jpeg-quality", type=int, default=70, help="JPEG quality of the streamed frames (default: 70)")
 	args = parser.parse_args()
 
 	tm_model = None
@@ -40,7 +46,6 @@ def main():
 	try:
 		import cv2
 		import numpy as np
-		from PIL import Image, ImageOps
 		try:
 			# Try using tf_keras (legacy bridge) first for better H5 compatibility
 			from tf_keras.models import load_model
@@ -49,18 +54,87 @@ def main():
 			from tensorflow.keras.models import load_model
 	except ImportError as e:
 		print(f"Missing dependency for Teachable Machine: {e}")
-		print("Ensure tensorflow, tf-keras, numpy, and pillow are installed.")
+		print("Ensure tensorflow, tf-keras, numpy, and opencv-python are installed.")
 		sys.exit(1)
 
-	print(f"Loading Teachable Machine model: {tm_model_path}")
-	# Compile=False is standard for TM models as we only predict
-	tm_model = load_model(str(tm_model_path), compile=False)
+	# OpenCV T-API: with --opencl, the crop/resize/cvtColor preprocessing runs on the GPU through UMat.
+	# The overlay and JPEG encode stay on the CPU frame, which TurboJPEG and the clip ring need anyway.
+	use_opencl = args.opencl and cv2.ocl.haveOpenCL()
+	cv2.ocl.setUseOpenCL(use_opencl)
+	if args.opencl and not use_opencl:
+		print("OpenCL not available, preprocessing on the CPU")
+
+	# Model input, allocated once and refilled in place for every frame
+	tm_size = (224, 224)
+	tm_input = np.empty((1, 224, 224, 3), dtype=np.float32)
+
+	# Prefer an ONNX export next to the .h5 (see README): onnxruntime avoids Keras predict() overhead
+	tm_session = None
+	tm_onnx_path = tm_model_path.with_suffix(".onnx")
+	if tm_onnx_path.exists():
+		try:
+			import onnxruntime as ort
+		except ImportError:
+			print("onnxruntime not installed, falling back to the Keras model")
+		else:
+			print(f"Loading Teachable Machine ONNX model: {tm_onnx_path}")
+			so = ort.SessionOptions()
+			so.intra_op_num_threads = 2
+			tm_session = ort.InferenceSession(str(tm_onnx_path), sess_options=so, providers=['CPUExecutionProvider'])
+
+			# Bind tm_input and a preallocated output once; both are reused by every run
+			tm_output = np.empty((1, tm_session.get_outputs()[0].shape[-1]), dtype=np.float32)
+			io_binding = tm_session.io_binding()
+			io_binding.bind_ortvalue_input(tm_session.get_inputs()[0].name, ort.OrtValue.ortvalue_from_numpy(tm_input))
+			io_binding.bind_ortvalue_output(tm_session.get_outputs()[0].name, ort.OrtValue.ortvalue_from_numpy(tm_output))
+
+	tm_infer = None
+	if tm_session is None:
+		print(f"Loading Teachable Machine model: {tm_model_path}")
+		# Compile=False is standard for TM models as we only predict
+		tm_model = load_model(str(tm_model_path), compile=False)
+
+		# Compile the forward pass once with XLA: each frame is then a single graph call instead of
+		# going through predict()'s per-call setup
+		import tensorflow as tf
+
+		@tf.function(jit_compile=True, input_signature=[tf.TensorSpec(tm_input.shape, tf.float32)])
+		def tm_infer(x):
+			return tm_model(x, training=False)
+
+		try:
+			tm_infer(tm_input)
+		except Exception as e:
+			print(f"XLA compilation failed, using Keras predict(): {e}")
+			tm_infer = None
+
+	def tm_predict():
+		if tm_session is not None:
+			tm_session.run_with_iobinding(io_binding)
+			return tm_output
+		if tm_infer is not None:
+			return tm_infer(tm_input).numpy()
+		return tm_model.predict(tm_input, verbose=0)
 	
 	with open(tm_labels_path, "r") as f:
 		tm_labels = f.readlines()
 	
 	print(f"Loaded {len(tm_labels)} labels.")
 
+	# libjpeg-turbo (SIMD) encoder for the pushed frames; falls back to OpenCV if unavailable
+	try:
+		from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+		tj = TurboJPEG()
+	except Exception as e:
+		print(f"TurboJPEG unavailable, using OpenCV encoder: {e}")
+		tj = None
+
+	def encode_jpeg(img):
+		if tj is not None:
+			return tj.encode(img, quality=args.jpeg_quality, jpeg_subsample=TJSAMP_420, pixel_format=TJPF_BGR)
+		ret, buffer = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), args.jpeg_quality, int(cv2.IMWRITE_JPEG_OPTIMIZE), 0])
+		return buffer.tobytes() if ret else None
+
 	save_dir = Path(args.save_dir)
 	save_dir.mkdir(parents=True, exist_ok=True)
 
@@ -83,8 +157,65 @@ def main():
 	width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH) or 640)
 	height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) or 480)
 
+	# Resolved once. A failed encode (e.g. no NVENC here) switches it off, so later clips
+	# don't pay for starting ffmpeg and the encoder only to fall back anyway.
+	clip_encoder = args.clip_encoder if args.clip_encoder and shutil.which("ffmpeg") else None
+	# Use avc1 (H.264) for the OpenCV fallback
+	clip_fourcc = cv2.VideoWriter_fourcc(*'avc1')
+
+	def write_clip_ffmpeg(path, frames):
+		# Pipe raw frames to ffmpeg so the clip is encoded by --clip-encoder (hardware H.264 by default).
+		# Returns False if that wasn't possible, so the caller can fall back to cv2.VideoWriter.
+		nonlocal clip_encoder
+		if clip_encoder is None or len(frames) == 0:
+			return False
+		cmd = [
+			"ffmpeg", "-y", "-loglevel", "error",
+			"-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "pipe:",
+			"-c:v", clip_encoder, "-pix_fmt", "yuv420p", "-movflags", "+faststart", str(path)
+		]
+		try:
+			proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+			# The clip is one contiguous array (see save_clip), so it is piped in one write
+			_, err = proc.communicate(memoryview(frames).cast("B"))
+		except OSError as e:
+			print(f"ffmpeg encode failed, using OpenCV from now on: {e}")
+			clip_encoder = None
+			return False
+		if proc.returncode != 0:
+			print(f"ffmpeg {clip_encoder} encode failed, using OpenCV from now on: {err.decode(errors='replace').strip()}")
+			clip_encoder = None
+			return False
+		return True
+
+	def save_clip(path, frames):
+		# Runs on clip_pool: encode the clip, then hand it to the uploader
+		try:
+			if not write_clip_ffmpeg(path, frames):
+				writer = cv2.VideoWriter(str(path), clip_fourcc, fps, (width, height))
+				for f in frames:
+					writer.write(f)
+				writer.release()
+		except Exception as e:
+			print(f"Clip save error: {e}")
+			return
+		# Upload to agent in the background
+		submit_upload(path, args.camera_id, args.lat, args.long)
+
+	# One clip is written at a time, off the event loop, so capture and streaming carry on meanwhile
+	clip_pool = ThreadPoolExecutor(max_workers=1)
+
 	buffer_size = max(1, int(round(fps * float(args.buffer_seconds))))
-	frame_buffer = deque(maxlen=buffer_size)
+	# Clip buffer: one preallocated ring the camera decodes straight into, instead of a deque of separate arrays
+	ring = np.empty((buffer_size, height, width, 3), dtype=np.uint8)
+	ring_idx = 0
+	ring_full = False
+	# The streamed overlay is drawn into this one reused array rather than a fresh copy per frame
+	overlay = np.empty((height, width, 3), dtype=np.uint8)
+
+	def clip_frames():
+		# Oldest first. ring[ring_idx] is left out: it is the slot the capture thread is reading into.
+		return [ring[(ring_idx + i) % buffer_size] for i in range(1, buffer_size)]
 
 	print(f"Webcam opened {width}x{height} @ {fps} FPS, buffering {args.buffer_seconds}s ({buffer_size} frames).")
 	print(f"Saving clips to: {save_dir}")
@@ -100,6 +231,16 @@ def main():
              ws_url = ws_url.replace("/push/", "/ws/push/")
 	
 	print(f"WebSocket URL: {ws_url}")
+	# One-way JPEG stream: no permessage-deflate (JPEG doesn't compress), no limits on the
+	# (unused) receive side, and a bigger write buffer before send() waits
+	ws_options = {
+		"compression": None,
+		"max_queue": None,
+		"max_size": None,
+		"write_limit": 2 ** 20,
+		"ping_interval": 20,
+		"ping_timeout": 20,
+	}
 
 	import asyncio
 	try:
@@ -108,137 +249,164 @@ def main():
 		print("Missing dependency: websockets. Install with: pip install websockets")
 		sys.exit(1)
 
+	# cap.read blocks on the camera driver; one dedicated thread keeps reads in order
+	capture_pool = ThreadPoolExecutor(max_workers=1)
+
+	def put_latest(q, item):
+		# Drop the oldest item when the next stage is behind, so it always gets the freshest frame
+		if q.full():
+			q.get_nowait()
+		q.put_nowait(item)
+
 	async def run_loop():
-		last_presence = True
-		clip_count = 0
-		
-		# Connect to WebSocket
-		try:
-			async with websockets.connect(ws_url) as websocket:
-				print("Connected to WebSocket server")
-				
-				while True:
-					ret, frame = cap.read()
-					if not ret:
-						print("Webcam frame read failed, exiting")
-						break
+		loop = asyncio.get_running_loop()
+		frame_q = asyncio.Queue(maxsize=2)
+		send_q = asyncio.Queue(maxsize=2)
 
-					frame_buffer.append(frame.copy())
+		async def capture_task():
+			nonlocal ring_idx, ring_full
+			while True:
+				slot = ring[ring_idx]
+				ret, frame = await loop.run_in_executor(capture_pool, cap.read, slot)
+				if not ret:
+					print("Webcam frame read failed, exiting")
+					return
 
-					# Run detection
-					try:
-						annotated_frame = frame.copy()
-						presence = False
+				if frame.shape != slot.shape:
+					# The camera delivers a different size than it reported; fit the frame into the slot
+					frame = cv2.resize(frame, (width, height), dst=slot)
+				ring_idx = (ring_idx + 1) % buffer_size
+				ring_full = ring_full or ring_idx == 0
+				put_latest(frame_q, frame)
+
+		async def infer_task():
+			last_presence = True
+			clip_count = 0
+			frame_count = 0
+
+			while True:
+				frame = await frame_q.get()
 
+				# Run detection
+				try:
+					# The overlay is drawn on a copy: the buffered frame goes into the clip the agent classifies
+					np.copyto(overlay, frame)
+					annotated_frame = overlay
+					presence = False
+
+					# Only every --detect-every'th frame is classified; the ones in between reuse the last prediction
+					if frame_count % args.detect_every == 0:
 						# Teachable Machine Logic
-						# Preprocess: CV2(BGR) -> PIL(RGB) -> Resize -> Normalize
-						rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-						pil_image = Image.fromarray(rgb_frame)
-						
-						# Resize and crop to 224x224
-						size = (224, 224)
-						pil_image = ImageOps.fit(pil_image, size, Image.Resampling.LANCZOS)
-						
-						image_array = np.asarray(pil_image)
-						normalized_image_array = (image_array.astype(np.float32) / 127.5) - 1
-						
-						data = np.ndarray(shape=(1, 224, 224, 3), dtype=np.float32)
-						data[0] = normalized_image_array
-						
-						prediction = tm_model.predict(data, verbose=0)
-						index = np.argmax(prediction)
-						confidence_score = prediction[0][index]
-						
-						predicted_label_line = tm_labels[index] # e.g. "0 YES\n"
-						class_name = predicted_label_line.strip()
-						
-						# Draw on frame for debug
-						cv2.putText(annotated_frame, f"TM: {class_name} ({confidence_score:.2f})", (10, 30), 
-								   cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-
-						# Logic: Normal -> Safe (presence=True), Fire/Violence -> Trigger (presence=False)
+						# Preprocess: center crop (like ImageOps.fit) -> Resize -> BGR to RGB -> Normalize into tm_input
+						h, w = frame.shape[:2]
+						side = min(h, w)
+						top, left = (h - side) // 2, (w - side) // 2
+						if use_opencl:
+							# Crop, resize and color-convert through the T-API; only the 224x224 result comes back
+							crop = cv2.UMat(cv2.UMat(frame), (top, top + side), (left, left + side))
+							small = cv2.cvtColor(cv2.resize(crop, tm_size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB).get()
+						else:
+							small = cv2.resize(frame[top:top + side, left:left + side], tm_size, interpolation=cv2.INTER_AREA)
+							cv2.cvtColor(small, cv2.COLOR_BGR2RGB, dst=small)
+						np.multiply(small, 1 / 127.5, out=tm_input[0])
+						tm_input[0] -= 1
+					
+						# Inference runs in the default executor so capture keeps reading meanwhile
+						prediction = await loop.run_in_executor(None, tm_predict)
+					frame_count += 1
+
+					index = np.argmax(prediction)
+					confidence_score = prediction[0][index]
+					
+					predicted_label_line = tm_labels[index] # e.g. "0 YES\n"
+					class_name = predicted_label_line.strip()
+					
+					# Draw on frame for debug
+					cv2.putText(annotated_frame, f"TM: {class_name} ({confidence_score:.2f})", (10, 30), 
+							   cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+
+					# Logic: Normal -> Safe (presence=True), Fire/Violence -> Trigger (presence=False)
+					status_text = "SAFE"
+					status_color = (0, 255, 0) # Green
+
+					if "Normal" in class_name:
+						presence = True
 						status_text = "SAFE"
-						status_color = (0, 255, 0) # Green
-
-						if "Normal" in class_name:
-							presence = True
-							status_text = "SAFE"
-							status_color = (0, 255, 0)
-						elif "Fire" in class_name or "Violence" in class_name:
-							presence = False
-							status_text = f"ALERT: {class_name}"
-							status_color = (0, 0, 255) # Red
-						
-						# Draw status on frame
-						cv2.putText(annotated_frame, status_text, (10, 70), 
-								   cv2.FONT_HERSHEY_SIMPLEX, 1, status_color, 2)
-						
-						# Push frame via WebSocket
-						try:
-							ret, buffer = cv2.imencode('.jpg', annotated_frame)
-							if ret:
-								await websocket.send(buffer.tobytes())
-						except Exception as e:
-							print(f"WS Send error: {e}")
-							# Break to trigger reconnect logic if critical, or just pass
-							# For now, let's try to ignore single frame errors but if socket closed it will raise
-
-					except Exception as e:
-						print(f"Inference/Send error: {e}")
-						# Allow loop to continue (maybe model error), but sleep a bit
-						await asyncio.sleep(0.01)
-
-					# Recording logic
-					if not presence and last_presence and len(frame_buffer) == buffer_size:
-						timestamp = time.strftime('%Y%m%d_%H%M%S')
-						out_path = save_dir / f"clip_event_{timestamp}_{clip_count}.mp4"
-						fourcc = cv2.VideoWriter_fourcc(*'avc1')
-						writer = cv2.VideoWriter(str(out_path), fourcc, fps, (width, height))
-						print(f"!!! EVENT DETECTED ({class_name}) !!! Saving {args.buffer_seconds}s clip to {out_path}")
-						for f in frame_buffer:
-							writer.write(f)
-						writer.release()
-						
-						
-						# Upload to agent in a separate thread
-						def upload_worker(path, cam_id, lat, long):
-							try:
-								print(f"Sending {path.name} to agent...")
-								with open(path, 'rb') as f:
-									files = {'file': (path.name, f, 'video/mp4')}
-									data_payload = {
-										'camera_id': cam_id,
-										'latitude': lat,
-										'longitude': long
-									}
-									# Add timeout to prevent hanging
-									agent_url = os.getenv("AGENT_API_URL", "http://localhost:8001/agent")
-									response = requests.post(agent_url, files=files, data=data_payload, timeout=30)
-									if response.status_code == 200:
-										print(f"Successfully sent {path.name} to agent.")
-									else:
-										print(f"Failed sent {path.name}. Status: {response.status_code}")
-							except Exception as e:
-								print(f"Error sending to agent: {e}")
-
-						import threading
-						upload_thread = threading.Thread(
-							target=upload_worker, 
-							args=(out_path, args.camera_id, args.lat, args.long)
-						)
-						upload_thread.start()
-
-						clip_count += 1
-						last_presence = False
-						print("State changed to ALERT (Recording sent). Waiting for Normal state to reset...")
-
-					if presence and not last_presence:
-						print("State returned to NORMAL. System re-armed for next event.")
-						last_presence = True
-					elif presence:
-						last_presence = True
-
-					await asyncio.sleep(0.001)
+						status_color = (0, 255, 0)
+					elif "Fire" in class_name or "Violence" in class_name:
+						presence = False
+						status_text = f"ALERT: {class_name}"
+						status_color = (0, 0, 255) # Red
+					
+					# Draw status on frame
+					cv2.putText(annotated_frame, status_text, (10, 70), 
+							   cv2.FONT_HERSHEY_SIMPLEX, 1, status_color, 2)
+					
+					# Encoding is CPU-bound (libjpeg releases the GIL), keep it off the event loop
+					buffer = await loop.run_in_executor(None, encode_jpeg, annotated_frame)
+					# Hand the frame to the sender so the socket write overlaps the next inference
+					if buffer is not None:
+						put_latest(send_q, buffer)
+
+				except Exception as e:
+					print(f"Inference error: {e}")
+					# Allow loop to continue (maybe model error), but sleep a bit
+					await asyncio.sleep(0.01)
+
+				# Recording logic
+				if not presence and last_presence and ring_full:
+					timestamp = time.strftime('%Y%m%d_%H%M%S')
+					out_path = save_dir / f"clip_event_{timestamp}_{clip_count}.mp4"
+					print(f"!!! EVENT DETECTED ({class_name}) !!! Saving {args.buffer_seconds}s clip to {out_path}")
+					# Copied out of the ring, which capture keeps overwriting while the clip is written
+					clip_pool.submit(save_clip, out_path, np.stack(clip_frames()))
+
+					clip_count += 1
+					last_presence = False
+					print("State changed to ALERT (Recording sent). Waiting for Normal state to reset...")
+
+				if presence and not last_presence:
+					print("State returned to NORMAL. System re-armed for next event.")
+					last_presence = True
+				elif presence:
+					last_presence = True
+
+		async def send_task(websocket):
+			while True:
+				# Frames that queued up during the previous send go out together in one message,
+				# each prefixed with its 4-byte length (the livestream hub splits them again)
+				frames = [await send_q.get()]
+				while not send_q.empty():
+					frames.append(send_q.get_nowait())
+				if len(frames) == 1:
+					message = frames[0]
+				else:
+					message = b"".join(part for f in frames for part in (len(f).to_bytes(4, "big"), f))
+				try:
+					await websocket.send(message)
+				except websockets.exceptions.ConnectionClosed:
+					raise
+				except Exception as e:
+					print(f"WS Send error: {e}")
+
+		# Connect to WebSocket
+		try:
+			async with websockets.connect(ws_url, **ws_options) as websocket:
+				print("Connected to WebSocket server")
+
+				tasks = [
+					asyncio.create_task(capture_task()),
+					asyncio.create_task(infer_task()),
+					asyncio.create_task(send_task(websocket)),
+				]
+				try:
+					done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+				finally:
+					for task in tasks:
+						task.cancel()
+				# Re-raise whatever stopped the pipeline (e.g. the socket closing)
+				for task in done:
+					task.result()
 
 		except (websockets.exceptions.ConnectionClosedError, ConnectionRefusedError) as e:
 			print(f"WebSocket connection failed/closed: {e}. Retrying in 5s...")
@@ -257,8 +425,15 @@ def main():
 				print(f"Restarting loop due to: {e}")
 				await asyncio.sleep(5)
 				
+	# uvloop (libuv, C callbacks and socket I/O) for the asyncio loop; not available on Windows
+	try:
+		import uvloop
+		run_async = uvloop.run
+	except ImportError:
+		run_async = asyncio.run
+
 	try:
-		asyncio.run(main_async())
+		run_async(main_async())
 	finally:
 		cap.release()
 
@@ -1,8 +1,11 @@
 import argparse
+import json
 import sys
 import time
-import requests
-from collections import deque
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from uploader import submit_upload
 from pathlib import Path
 
 def main():
@@ -20,8 +23,18 @@ def main():
 	parser.add_argument("--camera-id", default="cam1", help="Camera ID (default: cam1)")
 	parser.add_argument("--lat", type=str, default="0.0", help="Latitude (default: 0.0)")
 	parser.add_argument("--long", type=str, default="0.0", help="Longitude (default: 0.0)")
+	parser.add_argument("--batch-size", type=int, default=2, help="Max frames per YOLO inference call (default: 2)")
+	parser.add_argument("--int8", action="store_true", help="Build the TensorRT engine in INT8 instead of FP16; needs --calib-data")
+	parser.add_argument("--calib-data", default=None, help="Dataset yaml with representative frames for INT8 calibration")
+	parser.add_argument("--clip-encoder", default=os.getenv("CLIP_ENCODER", "h264_nvenc"), help="ffmpeg video encoder for saved clips, e.g. h264_nvenc, h264_vaapi, libx264 (default: h264_nvenc)")
+	parser.add_argument("--detect-every", type=int, default=3, help="Run YOLO on every Nth frame; frames in between reuse the last detections (default: 3)")
+	parser.add_argument("--jpeg-quality", type=int, default=70, help="JPEG quality of the streamed frames (default: 70)")
 	args = parser.parse_args()
 
+	if args.int8 and not args.calib_data:
+		print("INT8 engine export needs calibration images: pass --calib-data <dataset.yaml>")
+		sys.exit(1)
+
 	model_path = Path(args.model)
 	if not model_path.exists():
 		print(f"Model file not found: {model_path}\nPlace your model next to this script or provide --model path.")
@@ -35,13 +48,79 @@ def main():
 
 	try:
 		import cv2
+		import numpy as np
 	except Exception:
 		print("Missing dependency: opencv-python. Install from requirements.txt or run: python -m pip install opencv-python")
 		raise
 
-	print(f"Loading YOLO model: {model_path}")
-	model = YOLO(str(model_path))
+	import torch
+	use_gpu = torch.cuda.is_available() and args.device != 'cpu'
+	# FP16 halves memory traffic on CUDA; CPU inference stays FP32
+	half = use_gpu
+
+	def engine_batch(path):
+		# Ultralytics prefixes the engine with its export metadata (4-byte length + JSON)
+		try:
+			with open(path, "rb") as f:
+				meta_len = int.from_bytes(f.read(4), byteorder="little")
+				return int(json.loads(f.read(meta_len).decode("utf-8"))["batch"])
+		except Exception:
+			return None
+
+	load_path = model_path
+	if use_gpu and model_path.suffix == ".pt":
+		# TensorRT engine next to the weights, built on the first run and reused afterwards.
+		# Same naming as vision-model/yolo_runtime.py: INT8 goes to <stem>.int8.engine, FP16 to <stem>.engine
+		engine_path = model_path.with_suffix(".int8.engine" if args.int8 else ".engine")
+		if engine_path.exists():
+			built_batch = engine_batch(engine_path)
+			if built_batch is None:
+				print(f"Warning: could not read the batch size {engine_path} was built for; delete it if --batch-size {args.batch_size} fails")
+			elif built_batch < args.batch_size:
+				print(f"{engine_path} was built for batch {built_batch}, rebuilding for --batch-size {args.batch_size}")
+				engine_path.unlink()
+		if not engine_path.exists():
+			print(f"Exporting TensorRT engine to {engine_path} (one-time, this takes a few minutes)...")
+			# Ultralytics names the engine after the weights, so INT8 exports from a <stem>.int8.pt copy
+			source = model_path.with_suffix(".int8.pt") if args.int8 else model_path
+			try:
+				if source != model_path:
+					shutil.copyfile(model_path, source)
+				YOLO(str(source)).export(
+					format="engine",
+					half=not args.int8,
+					int8=args.int8,
+					data=args.calib_data,
+					imgsz=640,
+					batch=args.batch_size,
+					dynamic=True,
+					device=args.device or 0,
+				)
+			except Exception as e:
+				print(f"TensorRT export failed, using the PyTorch model: {e}")
+			finally:
+				if source != model_path and source.exists():
+					source.unlink()
+		if engine_path.exists():
+			load_path = engine_path
+
+	print(f"Loading YOLO model: {load_path}")
+	model = YOLO(str(load_path))
 	
+	# libjpeg-turbo (SIMD) encoder for the pushed frames; falls back to OpenCV if unavailable
+	try:
+		from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+		tj = TurboJPEG()
+	except Exception as e:
+		print(f"TurboJPEG unavailable, using OpenCV encoder: {e}")
+		tj = None
+
+	def encode_jpeg(img):
+		if tj is not None:
+			return tj.encode(img, quality=args.jpeg_quality, jpeg_subsample=TJSAMP_420, pixel_format=TJPF_BGR)
+		ret, buffer = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), args.jpeg_quality, int(cv2.IMWRITE_JPEG_OPTIMIZE), 0])
+		return buffer.tobytes() if ret else None
+
 	save_dir = Path(args.save_dir)
 	save_dir.mkdir(parents=True, exist_ok=True)
 
@@ -63,8 +142,63 @@ def main():
 	width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH) or 640)
 	height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) or 480)
 
+	# Resolved once. A failed encode (e.g. no NVENC here) switches it off, so later clips
+	# don't pay for starting ffmpeg and the encoder only to fall back anyway.
+	clip_encoder = args.clip_encoder if args.clip_encoder and shutil.which("ffmpeg") else None
+	# Use avc1 (H.264) for the OpenCV fallback
+	clip_fourcc = cv2.VideoWriter_fourcc(*'avc1')
+
+	def write_clip_ffmpeg(path, frames):
+		# Pipe raw frames to ffmpeg so the clip is encoded by --clip-encoder (hardware H.264 by default).
+		# Returns False if that wasn't possible, so the caller can fall back to cv2.VideoWriter.
+		nonlocal clip_encoder
+		if clip_encoder is None or len(frames) == 0:
+			return False
+		cmd = [
+			"ffmpeg", "-y", "-loglevel", "error",
+			"-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "pipe:",
+			"-c:v", clip_encoder, "-pix_fmt", "yuv420p", "-movflags", "+faststart", str(path)
+		]
+		try:
+			proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+			# The clip is one contiguous array (see save_clip), so it is piped in one write
+			_, err = proc.communicate(memoryview(frames).cast("B"))
+		except OSError as e:
+			print(f"ffmpeg encode failed, using OpenCV from now on: {e}")
+			clip_encoder = None
+			return False
+		if proc.returncode != 0:
+			print(f"ffmpeg {clip_encoder} encode failed, using OpenCV from now on: {err.decode(errors='replace').strip()}")
+			clip_encoder = None
+			return False
+		return True
+
+	def save_clip(path, frames):
+		# Runs on clip_pool: encode the clip, then hand it to the uploader
+		try:
+			if not write_clip_ffmpeg(path, frames):
+				writer = cv2.VideoWriter(str(path), clip_fourcc, fps, (width, height))
+				for f in frames:
+					writer.write(f)
+				writer.release()
+		except Exception as e:
+			print(f"Clip save error: {e}")
+			return
+		# Upload to agent in the background
+		submit_upload(path, args.camera_id, args.lat, args.long)
+
+	# One clip is written at a time, off the event loop, so capture and streaming carry on meanwhile
+	clip_pool = ThreadPoolExecutor(max_workers=1)
+
 	buffer_size = max(1, int(round(fps * float(args.buffer_seconds))))
-	frame_buffer = deque(maxlen=buffer_size)
+	# Clip buffer: one preallocated ring the camera decodes straight into, instead of a deque of separate arrays
+	ring = np.empty((buffer_size, height, width, 3), dtype=np.uint8)
+	ring_idx = 0
+	ring_full = False
+
+	def clip_frames():
+		# Oldest first. ring[ring_idx] is left out: it is the slot the capture thread is reading into.
+		return [ring[(ring_idx + i) % buffer_size] for i in range(1, buffer_size)]
 
 	# Determine person class index if available
 	person_class = None
@@ -84,6 +218,22 @@ def main():
 	except Exception:
 		person_class = None
 
+	# Only people matter for presence, so let NMS drop every other class
+	predict_kwargs = dict(conf=args.conf, device=args.device or None, half=half, verbose=False)
+	if person_class is not None:
+		predict_kwargs["classes"] = [person_class]
+
+	def run_yolo(frames):
+		# The first call sets up Ultralytics' predictor with predict_kwargs; later calls go to it
+		# directly and skip YOLO.predict's per-call config merge and validation
+		if model.predictor is None:
+			return model.predict(frames, **predict_kwargs)
+		return model.predictor(frames)
+
+	# Warm up on a full batch of camera-sized frames: the first call pays for CUDA/TensorRT
+	# setup and kernel selection, which would otherwise stall the first streamed frames
+	run_yolo([np.zeros((height, width, 3), dtype=np.uint8)] * args.batch_size)
+
 	print(f"Webcam opened {width}x{height} @ {fps} FPS, buffering {args.buffer_seconds}s ({buffer_size} frames).")
 	print(f"Saving clips to: {save_dir}")
 	print(f"Streaming to: {args.stream_url}")
@@ -97,6 +247,16 @@ def main():
              ws_url = ws_url.replace("/push/", "/ws/push/")
 	
 	print(f"WebSocket URL: {ws_url}")
+	# One-way JPEG stream: no permessage-deflate (JPEG doesn't compress), no limits on the
+	# (unused) receive side, and a bigger write buffer before send() waits
+	ws_options = {
+		"compression": None,
+		"max_queue": None,
+		"max_size": None,
+		"write_limit": 2 ** 20,
+		"ping_interval": 20,
+		"ping_timeout": 20,
+	}
 
 	import asyncio
 	try:
@@ -105,120 +265,102 @@ def main():
 		print("Missing dependency: websockets. Install with: pip install websockets")
 		sys.exit(1)
 
+	# cap.read blocks on the camera driver; one dedicated thread keeps reads in order
+	capture_pool = ThreadPoolExecutor(max_workers=1)
+
+	def put_latest(q, item):
+		# Drop the oldest item when the next stage is behind, so it always gets the freshest frame
+		if q.full():
+			q.get_nowait()
+		q.put_nowait(item)
+
 	async def run_loop():
-		last_presence = True
-		clip_count = 0
-		
-		# Connect to WebSocket
-		try:
-			async with websockets.connect(ws_url) as websocket:
-				print("Connected to WebSocket server")
-				
-				while True:
-					ret, frame = cap.read()
-					if not ret:
-						print("Webcam frame read failed, exiting")
-						break
+		loop = asyncio.get_running_loop()
+		frame_q = asyncio.Queue(maxsize=max(2, args.batch_size))
+		send_q = asyncio.Queue(maxsize=2)
+
+		async def capture_task():
+			nonlocal ring_idx, ring_full
+			while True:
+				slot = ring[ring_idx]
+				ret, frame = await loop.run_in_executor(capture_pool, cap.read, slot)
+				if not ret:
+					print("Webcam frame read failed, exiting")
+					return
+
+				if frame.shape != slot.shape:
+					# The camera delivers a different size than it reported; fit the frame into the slot
+					frame = cv2.resize(frame, (width, height), dst=slot)
+				ring_idx = (ring_idx + 1) % buffer_size
+				ring_full = ring_full or ring_idx == 0
+				put_latest(frame_q, frame)
 
-					frame_buffer.append(frame.copy())
+		async def infer_task():
+			last_presence = True
+			clip_count = 0
+			frame_count = 0
+			last_res = None
 
-					# Run detection
+			while True:
+				# Take the queued frames, waiting at most one frame interval to fill the batch
+				frames = [await frame_q.get()]
+				deadline = loop.time() + 1.0 / fps
+				while len(frames) < args.batch_size:
+					timeout = deadline - loop.time()
+					if timeout <= 0:
+						break
 					try:
-						annotated_frame = frame.copy()
-						presence = False
+						frames.append(await asyncio.wait_for(frame_q.get(), timeout))
+					except asyncio.TimeoutError:
+						break
 
-						results = model(frame, conf=args.conf, device=args.device or None)
-						res = results[0]
-						annotated_frame = res.plot()
-						
-						# YOLO Presence logic
-						if hasattr(res, 'boxes') and res.boxes is not None:
-							cls = None
-							try:
-								cls = res.boxes.cls
-							except Exception:
-								try:
-									data = res.boxes.data
-									if data is not None:
-										cls = data[:, 5]
-								except Exception:
-									cls = None
-
-							if cls is not None:
-								try:
-									arr = cls.cpu().numpy()
-								except Exception:
-									try:
-										arr = cls.numpy()
-									except Exception:
-										arr = list(cls)
-
-								for c in arr:
-									if person_class is not None:
-										if int(c) == int(person_class):
-											presence = True
-											break
-									else:
-										try:
-											if int(c) < len(model.names) and str(model.names[int(c)]).lower() == 'person':
-												presence = True
-												break
-										except Exception:
-											pass
-						
-						# Push frame via WebSocket
-						try:
-							ret, buffer = cv2.imencode('.jpg', annotated_frame)
-							if ret:
-								await websocket.send(buffer.tobytes())
-						except Exception as e:
-							print(f"WS Send error: {e}")
-							# Break to trigger reconnect logic if critical, or just pass
-							# For now, let's try to ignore single frame errors but if socket closed it will raise
+				# Only every --detect-every'th frame goes through YOLO; the ones in between reuse the last result
+				fresh = [(frame_count + i) % args.detect_every == 0 for i in range(len(frames))]
+				detect_frames = [f for f, is_fresh in zip(frames, fresh) if is_fresh]
 
+				# Run detection on the whole batch in one call, in the default executor so capture keeps reading meanwhile
+				results = []
+				if detect_frames:
+					try:
+						results = await loop.run_in_executor(None, run_yolo, detect_frames)
 					except Exception as e:
-						print(f"Inference/Send error: {e}")
+						print(f"Inference error: {e}")
 						# Allow loop to continue (maybe model error), but sleep a bit
 						await asyncio.sleep(0.01)
+						continue
+				frame_count += len(frames)
+				new_results = iter(results)
+
+				for frame, is_fresh in zip(frames, fresh):
+					if is_fresh:
+						last_res = next(new_results)
+					elif last_res is None:
+						continue
+					res = last_res
+					presence = False
+					try:
+						# Skipped frames get the last result's boxes drawn on them
+						annotated_frame = res.plot() if is_fresh else res.plot(img=frame)
+
+						# YOLO Presence logic: results only hold person boxes
+						presence = person_class is not None and res.boxes is not None and len(res.boxes) > 0
+						
+						# Encoding is CPU-bound (libjpeg releases the GIL), keep it off the event loop
+						buffer = await loop.run_in_executor(None, encode_jpeg, annotated_frame)
+						# Hand the frame to the sender so the socket write overlaps the next inference
+						if buffer is not None:
+							put_latest(send_q, buffer)
+
+					except Exception as e:
+						print(f"Annotation error: {e}")
 
 					# Recording logic
-					if not presence and last_presence and len(frame_buffer) == buffer_size:
+					if not presence and last_presence and ring_full:
 						timestamp = time.strftime('%Y%m%d_%H%M%S')
 						out_path = save_dir / f"clip_no_person_{timestamp}_{clip_count}.mp4"
-						fourcc = cv2.VideoWriter_fourcc(*'avc1')
-						writer = cv2.VideoWriter(str(out_path), fourcc, fps, (width, height))
 						print(f"No person detected — saving {args.buffer_seconds}s clip to {out_path}")
-						for f in frame_buffer:
-							writer.write(f)
-						writer.release()
-						
-						
-						# Upload to agent in a separate thread
-						def upload_worker(path, cam_id, lat, long):
-							try:
-								print(f"Sending {path.name} to agent...")
-								with open(path, 'rb') as f:
-									files = {'file': (path.name, f, 'video/mp4')}
-									data_payload = {
-										'camera_id': cam_id,
-										'latitude': lat,
-										'longitude': long
-									}
-									agent_url = os.getenv("AGENT_API_URL", "http://localhost:8001/agent")
-									response = requests.post(agent_url, files=files, data=data_payload)
-									if response.status_code == 200:
-										print(f"Successfully sent {path.name} to agent.")
-									else:
-										print(f"Failed sent {path.name}. Status: {response.status_code}")
-							except Exception as e:
-								print(f"Error sending to agent: {e}")
-
-						import threading
-						upload_thread = threading.Thread(
-							target=upload_worker, 
-							args=(out_path, args.camera_id, args.lat, args.long)
-						)
-						upload_thread.start()
+						# Copied out of the ring, which capture keeps overwriting while the clip is written
+						clip_pool.submit(save_clip, out_path, np.stack(clip_frames()))
 
 						clip_count += 1
 						last_presence = False
@@ -226,7 +368,42 @@ def main():
 					if presence:
 						last_presence = True
 
-					await asyncio.sleep(0.001)
+		async def send_task(websocket):
+			while True:
+				# Frames that queued up during the previous send go out together in one message,
+				# each prefixed with its 4-byte length (the livestream hub splits them again)
+				frames = [await send_q.get()]
+				while not send_q.empty():
+					frames.append(send_q.get_nowait())
+				if len(frames) == 1:
+					message = frames[0]
+				else:
+					message = b"".join(part for f in frames for part in (len(f).to_bytes(4, "big"), f))
+				try:
+					await websocket.send(message)
+				except websockets.exceptions.ConnectionClosed:
+					raise
+				except Exception as e:
+					print(f"WS Send error: {e}")
+
+		# Connect to WebSocket
+		try:
+			async with websockets.connect(ws_url, **ws_options) as websocket:
+				print("Connected to WebSocket server")
+
+				tasks = [
+					asyncio.create_task(capture_task()),
+					asyncio.create_task(infer_task()),
+					asyncio.create_task(send_task(websocket)),
+				]
+				try:
+					done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+				finally:
+					for task in tasks:
+						task.cancel()
+				# Re-raise whatever stopped the pipeline (e.g. the socket closing)
+				for task in done:
+					task.result()
 
 		except (websockets.exceptions.ConnectionClosedError, ConnectionRefusedError) as e:
 			print(f"WebSocket connection failed/closed: {e}. Retrying in 5s...")
@@ -245,8 +422,15 @@ def main():
 				print(f"Restarting loop due to: {e}")
 				await asyncio.sleep(5)
 				
+	# uvloop (libuv, C callbacks and socket I/O) for the asyncio loop; not available on Windows
+	try:
+		import uvloop
+		run_async = uvloop.run
+	except ImportError:
+		run_async = asyncio.run
+
 	try:
-		asyncio.run(main_async())
+		run_async(main_async())
 	finally:
 		cap.release()
 
@@ -0,0 +1,43 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
+
+# One pooled session for every clip upload, so repeated events reuse the connection to the agent.
+# Retry only covers failed connects (POST bodies are never resent).
+HTTP_SESSION = requests.Session()
+HTTP_ADAPTER = HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.2))
+HTTP_SESSION.mount("http://", HTTP_ADAPTER)
+HTTP_SESSION.mount("https://", HTTP_ADAPTER)
+
+# Uploads run here instead of on a new thread per event
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+def upload(path, cam_id, lat, long):
+	"""Send a recorded clip to the agent."""
+	try:
+		print(f"Sending {path.name} to agent...")
+		with open(path, 'rb') as f:
+			# Stream the multipart body from disk instead of building it in memory
+			payload = MultipartEncoder(fields={
+				'file': (path.name, f, 'video/mp4'),
+				'camera_id': cam_id,
+				'latitude': lat,
+				'longitude': long
+			})
+			agent_url = os.getenv("AGENT_API_URL", "http://localhost:8001/agent")
+			# Add timeout to prevent hanging
+			response = HTTP_SESSION.post(agent_url, data=payload, headers={'Content-Type': payload.content_type}, timeout=30)
+			if response.status_code == 200:
+				print(f"Successfully sent {path.name} to agent.")
+			else:
+				print(f"Failed sent {path.name}. Status: {response.status_code}")
+	except Exception as e:
+		print(f"Error sending to agent: {e}")
+
+def submit_upload(path, cam_id, lat, long):
+	"""Upload a clip in the background."""
+	return UPLOAD_EXECUTOR.submit(upload, path, cam_id, lat, long)
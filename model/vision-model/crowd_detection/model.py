@@ -1,5 +1,6 @@
-from ultralytics import YOLO
 import os
+import numpy as np
+from yolo_runtime import load_model, create_stream, predict_on_stream
 
 class CrowdDetector:
     def __init__(self, model_path=None):
@@ -14,7 +15,8 @@ class CrowdDetector:
             model_path = os.path.join(os.path.dirname(__file__), 'yolo', 'yolov8n.pt')
             
         print(f"Loading Crowd Detection Model from: {model_path}")
-        self.model = YOLO(model_path)
+        self.model = load_model(model_path)
+        self.cuda_stream = create_stream()
         
     def detect(self, frame, conf_threshold=0.5):
         """
@@ -27,29 +29,41 @@ class CrowdDetector:
         Returns:
             list: List of detections (only persons).
         """
+        return self.detect_batch([frame], conf_threshold)[0]
+
+    def detect_batch(self, frames, conf_threshold=0.5):
+        """
+        Detect people in several frames with one batched inference call.
+
+        Args:
+            frames (list): Input images/frames (numpy.ndarray).
+            conf_threshold (float): Confidence threshold for detection.
+
+        Returns:
+            list: One list of detections per frame, in order.
+        """
         # Run inference, filtering for class 0 (person)
         # classes=0 argument creates a filter
-        results = self.model(frame, classes=0, verbose=False)
+        results = predict_on_stream(self.model, self.cuda_stream, frames, classes=0)
         
-        detections = []
+        batch_detections = []
         
         for result in results:
-            boxes = result.boxes
-            for box in boxes:
-                conf = float(box.conf[0])
-                
-                if conf >= conf_threshold:
-                    x1, y1, x2, y2 = box.xyxy[0].tolist()
-                    cls_id = int(box.cls[0])
-                    # Ensure it is a person (redundant if classes=0 used but safe)
-                    if cls_id == 0:
-                        label = "Person"
-                        
-                        detections.append({
-                            "bbox": [x1, y1, x2, y2],
-                            "confidence": conf,
-                            "class_id": cls_id,
-                            "label": label
-                        })
+            detections = []
+            # One device->host transfer for all boxes instead of several per box
+            boxes = result.boxes.cpu().numpy()
+            xyxy = boxes.xyxy
+            confs = boxes.conf
+            cls_ids = boxes.cls.astype(int)
+            # Ensure it is a person (redundant if classes=0 used but safe)
+            keep = (confs >= conf_threshold) & (cls_ids == 0)
+            for i in np.flatnonzero(keep):
+                detections.append({
+                    "bbox": xyxy[i].tolist(),
+                    "confidence": float(confs[i]),
+                    "class_id": int(cls_ids[i]),
+                    "label": "Person"
+                })
+            batch_detections.append(detections)
         
-        return detections
+        return batch_detections
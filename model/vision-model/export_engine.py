@@ -0,0 +1,38 @@
+import argparse
+import os
+import sys
+
+from yolo_runtime import export_engine
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Weights used by the vision system; yolo_runtime.load_model picks up a .int8.engine or .engine next to each one
+DEFAULT_WEIGHTS = [
+    os.path.join(current_dir, 'unified_detection', 'yolov8', 'unified.pt'),
+    os.path.join(current_dir, 'fight_detection', 'yolov8', 'yolos8.pt'),
+    os.path.join(current_dir, 'fire_detection', 'yolov8', 'yolon8.pt'),
+    os.path.join(current_dir, 'weapon_detection', 'Weapons-and-Knives-Detector-with-YOLOv8', 'runs', 'detect', 'Normal', 'weights', 'best.pt'),
+    os.path.join(current_dir, 'crowd_detection', 'yolo', 'yolov8n.pt'),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the detector weights to TensorRT engines (dynamic batch)")
+    parser.add_argument("weights", nargs="*", help="YOLO .pt files to export (default: every detector's weights that exist)")
+    parser.add_argument("--int8", action="store_true", help="INT8 instead of FP16 (saved as <weights>.int8.engine); needs --data for calibration")
+    parser.add_argument("--data", default=None, help="Dataset yaml with ~500 representative camera frames for INT8 calibration")
+    parser.add_argument("--imgsz", type=int, default=640, help="Input size baked into the engine (default: 640)")
+    parser.add_argument("--device", default="0", help="GPU to build the engine on (default: 0)")
+    args = parser.parse_args()
+
+    if args.int8 and not args.data:
+        print("INT8 export needs calibration images: pass --data <dataset.yaml>")
+        sys.exit(1)
+
+    weights = args.weights or [w for w in DEFAULT_WEIGHTS if os.path.exists(w)]
+    for path in weights:
+        print(f"Exporting {path} ({'INT8' if args.int8 else 'FP16'})...")
+        engine = export_engine(path, int8=args.int8, data=args.data, imgsz=args.imgsz, device=args.device)
+        print(f"Saved {engine}")
+
+if __name__ == "__main__":
+    main()
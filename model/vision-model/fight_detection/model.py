@@ -1,5 +1,6 @@
-from ultralytics import YOLO
 import os
+import numpy as np
+from yolo_runtime import load_model, create_stream, predict_on_stream
 
 class FightDetector:
     def __init__(self, model_path=None):
@@ -16,7 +17,8 @@ class FightDetector:
             model_path = os.path.join(current_dir, 'yolov8', 'yolos8.pt')
             
         print(f"Loading Fight Detection Model from: {model_path}")
-        self.model = YOLO(model_path)
+        self.model = load_model(model_path)
+        self.cuda_stream = create_stream()
         # Class 1 is Violence/Fight according to README
         self.target_class_id = 1 
 
@@ -32,25 +34,40 @@ class FightDetector:
             list: List of detections. Each detection is a dict/object or similar.
                   For now returning the raw result object wrapper or a simplified list.
         """
+        return self.detect_batch([frame], conf_threshold)[0]
+
+    def detect_batch(self, frames, conf_threshold=0.4):
+        """
+        Detect fights in several frames with one batched inference call.
+
+        Args:
+            frames (list): Input images/frames (numpy.ndarray).
+            conf_threshold (float): Confidence threshold for detection.
+
+        Returns:
+            list: One list of detections per frame, in order.
+        """
         # Run inference
-        results = self.model(frame, verbose=False)
+        results = predict_on_stream(self.model, self.cuda_stream, frames)
         
-        detections = []
+        batch_detections = []
         
         for result in results:
-            boxes = result.boxes
-            for box in boxes:
-                cls_id = int(box.cls[0])
-                conf = float(box.conf[0])
-                
-                # Check if it matches the fight class and confidence threshold
-                if cls_id == self.target_class_id and conf >= conf_threshold:
-                    x1, y1, x2, y2 = box.xyxy[0].tolist()
-                    detections.append({
-                        "bbox": [x1, y1, x2, y2],
-                        "confidence": conf,
-                        "class_id": cls_id,
-                        "label": "Violence"
-                    })
+            detections = []
+            # One device->host transfer for all boxes instead of several per box
+            boxes = result.boxes.cpu().numpy()
+            xyxy = boxes.xyxy
+            confs = boxes.conf
+            cls_ids = boxes.cls.astype(int)
+            # Check if it matches the fight class and confidence threshold
+            keep = (cls_ids == self.target_class_id) & (confs >= conf_threshold)
+            for i in np.flatnonzero(keep):
+                detections.append({
+                    "bbox": xyxy[i].tolist(),
+                    "confidence": float(confs[i]),
+                    "class_id": int(cls_ids[i]),
+                    "label": "Violence"
+                })
+            batch_detections.append(detections)
         
-        return detections
+        return batch_detections
@@ -4,12 +4,32 @@ import os
 import time
 import asyncio
 import threading
-import requests
+import orjson
+import struct
+import shutil
+import subprocess
+import httpx
 import numpy as np
 from collections import deque
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 import websockets
 
+# libjpeg-turbo (SIMD) codec for the outgoing frames; falls back to OpenCV if unavailable
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420
+    tj = TurboJPEG()
+except Exception as e:
+    print(f"TurboJPEG unavailable, using OpenCV codec: {e}")
+    tj = None
+
+# uvloop (libuv, C callbacks and socket I/O) for the asyncio loop; not available on Windows
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Add current directory to path just in case
 current_dir = os.path.dirname(os.path.abspath(__file__))
 if current_dir not in sys.path:
@@ -19,6 +39,8 @@ try:
     from fight_detection.model import FightDetector
     from fire_detection.model import FireDetector
     from weapon_detection.model import WeaponDetector
+    from unified_detection.model import UnifiedDetector
+    from yolo_runtime import resize_for_inference, limit_cpu_threads, core_pinning_initializer
 except ImportError as e:
     print(f"Import Error: {e}")
     print("Ensure you are running from 'model/vision-model/' or that the directories 'fight_detection' and 'fire_detection' are accessible.")
@@ -38,26 +60,156 @@ LATITUDE = "0.0"
 LONGITUDE = "0.0"
 # Camera Index: 0 is usually the built-in webcam. 1 is often the OBS Virtual Camera if the webcam is present.
 CAMERA_INDEX = 1 
+# H.264 encoder used for event clips through the ffmpeg CLI (h264_nvenc, h264_vaapi,
+# h264_videotoolbox, ...). Empty, a missing ffmpeg or an encoder failure all fall back
+# to OpenCV's software avc1 writer.
+CLIP_ENCODER = os.getenv("CLIP_ENCODER", "h264_nvenc")
+# Use avc1 (H.264) for better browser compatibility
+CLIP_FOURCC = cv2.VideoWriter_fourcc(*'avc1')
+
+# Capture backend: DirectShow on Windows (avoids MSMF errors), V4L2 on Linux, OpenCV's choice elsewhere
+if sys.platform == "win32":
+    CAMERA_BACKEND = cv2.CAP_DSHOW
+elif sys.platform.startswith("linux"):
+    CAMERA_BACKEND = cv2.CAP_V4L2
+else:
+    CAMERA_BACKEND = cv2.CAP_ANY
+
+# Combined fire/violence/weapon/person checkpoint (see unified_detection/combined.yaml).
+# Used instead of the three separate detectors when the file exists.
+UNIFIED_MODEL_PATH = os.getenv("UNIFIED_MODEL_PATH", os.path.join(current_dir, "unified_detection", "yolov8", "unified.pt"))
+
+# With the unified model, let Ultralytics' stream loader do capture + inference on every frame
+# instead of our capture thread and DETECT_EVERY subsampling
+PREDICT_STREAM = os.getenv("PREDICT_STREAM", "0") == "1"
+
+# Run the detectors on every Nth captured frame; frames in between reuse the last detections
+DETECT_EVERY = int(os.getenv("DETECT_EVERY", 5))
+
+# Quality of the JPEG frames streamed to the Livestream hub
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", 70))
+CV2_JPEG_PARAMS = [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY, int(cv2.IMWRITE_JPEG_OPTIMIZE), 0]
+
+# The push socket is one-way JPEG traffic: no permessage-deflate (JPEG doesn't compress),
+# no limits on the (unused) receive side, and a bigger write buffer before send() waits
+WS_CONNECT_OPTIONS = {
+    "compression": None,
+    "max_queue": None,
+    "max_size": None,
+    "write_limit": 2 ** 20,
+    "ping_interval": 20,
+    "ping_timeout": 20,
+}
+
+# (metadata, frame) pairs waiting for the socket writer; older pairs are dropped beyond this
+WRITE_QUEUE_SIZE = 4
+
+# How often to log how many captured frames the publish loop skipped (backpressure)
+DROP_REPORT_SECONDS = 30
+
+# Event clip uploads share one keep-alive connection pool on the event loop.
+# Transport retries only cover failed connects (POST bodies are never resent).
+UPLOAD_TIMEOUT = 30.0
+UPLOAD_LIMITS = httpx.Limits(max_keepalive_connections=4)
+UPLOAD_RETRIES = 3
+
+# When the livestream hub runs on the same machine, frames can be handed over through
+# shared memory instead of the WebSocket. The hub must list this camera in SHM_CAMERAS.
+USE_SHARED_MEMORY = os.getenv("LIVESTREAM_SHM", "0") == "1"
+# Layout must match backend/livestream/main.py: header (seq: u64, jpeg_len: u32, meta_len: u32)
+# followed by the JPEG and the detections JSON. seq is odd while a write is in progress.
+SHM_SIZE = 2 * 1024 * 1024
+SHM_HEADER = struct.Struct("<QII")
+
+def encode_jpeg(frame):
+    """Encodes a BGR frame to JPEG bytes."""
+    if tj is not None:
+        return tj.encode(frame, quality=JPEG_QUALITY, jpeg_subsample=TJSAMP_420)
+    ret, buffer = cv2.imencode('.jpg', frame, CV2_JPEG_PARAMS)
+    if ret:
+        return buffer.tobytes()
+    return None
+
+def open_camera(index):
+    """
+    Opens a webcam with the platform capture backend, MJPG over USB and a
+    one-frame driver queue so reads never return stale frames.
+    (Not every backend or camera honours these.)
+    """
+    cap = cv2.VideoCapture(index, CAMERA_BACKEND)
+    if not cap.isOpened():
+        cap = cv2.VideoCapture(index)
+    # FOURCC first: V4L2 picks the frame rates it offers per pixel format
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    cap.set(cv2.CAP_PROP_FPS, FPS)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap
+
+class SharedFrameSlot:
+    """Latest-frame slot in shared memory, polled by the livestream hub."""
+    def __init__(self, camera_id):
+        name = f"crowdshield_{camera_id}"
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=SHM_SIZE)
+            self.seq = 0
+        except FileExistsError:
+            # Left over from a previous run; keep counting from its sequence number
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.seq = (SHM_HEADER.unpack_from(self.shm.buf)[0] + 1) & ~1
+
+    def write(self, image, metadata: bytes):
+        image = memoryview(image).cast("B")
+        start = SHM_HEADER.size
+        end = start + len(image) + len(metadata)
+        if end > self.shm.size:
+            print(f"Frame too large for shared memory ({end} bytes), dropping it")
+            return
+
+        struct.pack_into("<Q", self.shm.buf, 0, self.seq + 1)
+        self.shm.buf[start:start + len(image)] = image
+        self.shm.buf[start + len(image):end] = metadata
+        struct.pack_into("<II", self.shm.buf, 8, len(image), len(metadata))
+        self.seq += 2
+        struct.pack_into("<Q", self.shm.buf, 0, self.seq)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
 
 class VisionSystem:
     def __init__(self):
         print("Initializing Vision System...")
-        self.fight_detector = FightDetector()
-        self.fire_detector = FireDetector()
-        self.weapon_detector = WeaponDetector()
+        if os.path.exists(UNIFIED_MODEL_PATH):
+            self.unified_detector = UnifiedDetector(UNIFIED_MODEL_PATH)
+        else:
+            self.unified_detector = None
+            limit_cpu_threads(3)
+            self.fight_detector = FightDetector()
+            self.fire_detector = FireDetector()
+            self.weapon_detector = WeaponDetector()
+        
+        self.use_predict_stream = PREDICT_STREAM and self.unified_detector is not None
         
         print(f"Opening Camera Index: {CAMERA_INDEX} (Targeting OBS Virtual Camera)")
-        self.cap = cv2.VideoCapture(CAMERA_INDEX)
+        self.camera_index = CAMERA_INDEX
+        self.cap = open_camera(CAMERA_INDEX)
         
         if not self.cap.isOpened():
             print(f"Warning: Could not open camera {CAMERA_INDEX}. Trying default 0...")
-            self.cap = cv2.VideoCapture(0)
+            self.camera_index = 0
+            self.cap = open_camera(0)
             
         self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH) or 640)
         self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT) or 480)
+        if self.use_predict_stream:
+            # Only opened to probe the frame size; Ultralytics opens the camera itself
+            self.cap.release()
         
         self.buffer_size = FPS * BUFFER_SECONDS
-        self.frame_buffer = deque(maxlen=self.buffer_size)
+        # Clip buffer: one preallocated ring of frames instead of a deque of separate arrays
+        self.ring = np.empty((self.buffer_size, self.height, self.width, 3), dtype=np.uint8)
+        self.ring_idx = 0
+        self.ring_full = False
         
         self.is_running = True
         self.last_event_time = 0
@@ -65,35 +217,107 @@ class VisionSystem:
         
         # Create recordings directory
         self.rec_dir = Path("recordings")
-        self.latest_frame = None
-        self.frame_lock = threading.Lock()
+        # (frame, seq, detections) of the newest capture. Replaced as a whole by the capture thread,
+        # so readers need no lock; seq lets the loops handle each frame once. The frame is its
+        # clip ring slot, which isn't overwritten until buffer_size frames later, so it is shared
+        # without copying. detections is only set by the prediction stream.
+        self.latest = (None, 0, None)
+        self.last_seq = 0
+        self.latest_detections = None
+        # Frames replaced by a newer capture before the loop got to them, since the last report
+        self.skipped_frames = 0
+        self.last_drop_report = time.monotonic()
+        # Guards the clip ring only. Re-entrant so capture_worker can decode into a slot and
+        # publish it under one hold.
+        self.frame_lock = threading.RLock()
+        
+        self.frame_counter = 0
+        self.last_metadata = None
+        
+        self.shared_slot = SharedFrameSlot(CAMERA_ID) if USE_SHARED_MEMORY else None
+        
+        # Resolved once. A failed encode (e.g. no NVENC on this machine) switches it off, so later
+        # events don't pay for starting ffmpeg and the encoder only to fall back anyway.
+        self.clip_encoder = CLIP_ENCODER if CLIP_ENCODER and shutil.which("ffmpeg") else None
+        
+        # Clip encoding runs here so it never blocks the streaming loop
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        # Created on the event loop in run(); uploads are scheduled onto that loop
+        self.http = None
+        self.loop = None
+        # One thread per detector, so the three inferences always overlap instead of
+        # competing with encode/decode work for the default executor. On CPU each of the
+        # three detectors' threads also gets its own cores.
+        self.detector_pool = ThreadPoolExecutor(
+            max_workers=3,
+            initializer=core_pinning_initializer(3) if self.unified_detector is None else None,
+        )
         
         # Start capture thread
-        self.capture_thread = threading.Thread(target=self.capture_worker, daemon=True)
+        worker = self.predict_stream_worker if self.use_predict_stream else self.capture_worker
+        self.capture_thread = threading.Thread(target=worker, daemon=True)
         self.capture_thread.start()
 
+    def publish_frame(self, frame, detections=None):
+        """
+        Append a captured frame to the clip ring and make its ring slot the latest frame.
+        Frames already decoded into their slot (see capture_worker) are not copied again.
+        """
+        with self.frame_lock:
+            slot = self.ring[self.ring_idx]
+            if frame.shape != slot.shape:
+                cv2.resize(frame, (self.width, self.height), dst=slot)
+            elif frame.ctypes.data != slot.ctypes.data:
+                slot[...] = frame
+            self.ring_idx = (self.ring_idx + 1) % self.buffer_size
+            if self.ring_idx == 0:
+                self.ring_full = True
+        self.latest = (slot, self.latest[1] + 1, detections)
+
+    def predict_stream_worker(self):
+        """Thread that runs the unified model over Ultralytics' camera stream."""
+        print("Prediction stream started.")
+        while self.is_running:
+            try:
+                for frame, detections in self.unified_detector.stream(self.camera_index, conf_threshold=0.5):
+                    if not self.is_running:
+                        return
+                    self.publish_frame(frame, detections)
+            except Exception as e:
+                print(f"Warning: Prediction stream stopped: {e}")
+            time.sleep(1)
+
     def capture_worker(self):
         """Thread to capture frames at fixed FPS."""
         print("Capture thread started.")
+        frame_interval = 1.0 / FPS
+        next_frame_time = time.monotonic()
         while self.is_running:
             if not self.cap.isOpened():
                 time.sleep(1)
                 continue
-                
-            ret, frame = self.cap.read()
-            if ret:
-                with self.frame_lock:
-                    self.latest_frame = frame
-                    self.frame_buffer.append(frame)
-            else:
+            
+            # grab() blocks at the camera's own rate, so no sleep is needed
+            if not self.cap.grab():
                 print("Warning: Could not read frame in capture thread.")
                 time.sleep(1)
+                continue
+            
+            # Camera runs faster than FPS: drop this frame without decoding it
+            now = time.monotonic()
+            if now + 0.25 * frame_interval < next_frame_time:
+                continue
+            next_frame_time = max(next_frame_time + frame_interval, now)
             
-            # Maintain approximate FPS
-            time.sleep(1.0 / FPS)
+            # Decode straight into the ring slot the frame will occupy: no allocation and no copy.
+            # A slot is only reused buffer_size frames later, long after the loops are done with it.
+            with self.frame_lock:
+                ret, frame = self.cap.retrieve(self.ring[self.ring_idx])
+                if ret:
+                    self.publish_frame(frame)
 
-    def upload_event_worker(self, video_path, event_type):
-        """Thread worker to upload video to agent."""
+    async def upload_event(self, video_path, event_type):
+        """Upload the event clip to the agent over the shared HTTP client."""
         try:
             print(f"Uploading {video_path} to Agent...")
             with open(video_path, 'rb') as f:
@@ -103,12 +327,36 @@ class VisionSystem:
                     'latitude': LATITUDE,
                     'longitude': LONGITUDE
                 }
-                # Timeout to prevent hanging
-                requests.post(AGENT_URL, files=files, data=data, timeout=30)
+                await self.http.post(AGENT_URL, files=files, data=data)
             print(f"Successfully sent {event_type} event to Agent.")
         except Exception as e:
             print(f"Failed to upload event: {e}")
 
+    def write_clip_ffmpeg(self, filepath, frames):
+        """Encode the clip with ffmpeg and self.clip_encoder. Returns False if that wasn't possible."""
+        if self.clip_encoder is None or len(frames) == 0:
+            return False
+        
+        cmd = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{self.width}x{self.height}", "-r", str(FPS), "-i", "pipe:",
+            "-c:v", self.clip_encoder, "-pix_fmt", "yuv420p", "-movflags", "+faststart", str(filepath)
+        ]
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            # The snapshot is one contiguous array, so it can be piped without copying
+            _, err = proc.communicate(memoryview(frames).cast("B"))
+        except OSError as e:
+            print(f"ffmpeg failed to start: {e}")
+            self.clip_encoder = None
+            return False
+        
+        if proc.returncode != 0:
+            print(f"ffmpeg {self.clip_encoder} encode failed, using OpenCV from now on: {err.decode(errors='replace').strip()}")
+            self.clip_encoder = None
+            return False
+        return True
+
     def trigger_event(self, frame_buffer_snapshot, event_type: str):
         """Save video and trigger upload."""
         timestamp = time.strftime('%Y%m%d_%H%M%S')
@@ -118,121 +366,217 @@ class VisionSystem:
         print(f"!!! {event_type} DETECTED !!! Saving clip to {filepath}")
         
         # Save video
-        # Use avc1 (H.264) for better browser compatibility
-        fourcc = cv2.VideoWriter_fourcc(*'avc1')
-        out = cv2.VideoWriter(str(filepath), fourcc, FPS, (self.width, self.height))
+        if not self.write_clip_ffmpeg(filepath, frame_buffer_snapshot):
+            out = cv2.VideoWriter(str(filepath), CLIP_FOURCC, FPS, (self.width, self.height))
+            
+            for frame in frame_buffer_snapshot:
+                out.write(frame)
+            out.release()
+        
+        # trigger_event runs on the executor, so hand the upload to the event loop
+        asyncio.run_coroutine_threadsafe(self.upload_event(filepath, event_type), self.loop)
+
+    def get_latest_frame(self):
+        """The most recent captured frame, or None if there is no new one since the last call."""
+        frame, seq, detections = self.latest
+        if frame is None or seq == self.last_seq:
+            return None
+        self.skipped_frames += seq - self.last_seq - 1
+        self.last_seq = seq
+        now = time.monotonic()
+        if now - self.last_drop_report >= DROP_REPORT_SECONDS:
+            print(f"Skipped {self.skipped_frames} stale frames in the last {now - self.last_drop_report:.0f}s")
+            self.skipped_frames = 0
+            self.last_drop_report = now
+        self.latest_detections = detections
+        return frame
+
+    async def detect_subsampled(self, frame):
+        """
+        Runs the detectors on every DETECT_EVERY-th frame and reuses the last detections otherwise.
+        Returns (metadata, fresh), where fresh is True when the detectors actually ran.
+        """
+        if self.use_predict_stream:
+            # Detections arrived with the frame from the prediction stream
+            groups = self.latest_detections
+            self.last_metadata = {
+                "type": "detections",
+                "fight": groups["fight"],
+                "fire": groups["fire"],
+                "weapon": groups["weapon"]
+            }
+            return self.last_metadata, True
+        
+        self.frame_counter += 1
+        if self.last_metadata is None or self.frame_counter % DETECT_EVERY == 0:
+            self.last_metadata = await self.detect(frame)
+            return self.last_metadata, True
+        return self.last_metadata, False
+
+    async def detect(self, frame):
+        """Runs all detectors on a frame and returns the detections metadata."""
+        # Resize once for all detectors; boxes are mapped back to the full frame below
+        infer_frame, scale = resize_for_inference(frame)
+        loop = asyncio.get_running_loop()
         
-        for frame in frame_buffer_snapshot:
-            out.write(frame)
-        out.release()
+        if self.unified_detector is not None:
+            # One pass of the combined model covers all three detections
+            groups = await loop.run_in_executor(self.detector_pool, self.unified_detector.detect, infer_frame, 0.5)
+            fight_detections, fire_detections, weapon_detections = groups["fight"], groups["fire"], groups["weapon"]
+        else:
+            # Run Detections in parallel
+            # Using asyncio.gather to run all detections concurrently
+            fight_detections, fire_detections, weapon_detections = await asyncio.gather(
+                loop.run_in_executor(self.detector_pool, self.fight_detector.detect, infer_frame, 0.5),
+                loop.run_in_executor(self.detector_pool, self.fire_detector.detect, infer_frame, 0.5),
+                loop.run_in_executor(self.detector_pool, self.weapon_detector.detect, infer_frame, 0.5)
+            )
         
-        # Start upload thread
-        t = threading.Thread(target=self.upload_event_worker, args=(filepath, event_type))
-        t.start()
+        if scale != 1.0:
+            for det in fight_detections + fire_detections + weapon_detections:
+                det["bbox"] = [v / scale for v in det["bbox"]]
+        
+        return {
+            "type": "detections",
+            "fight": fight_detections,
+            "fire": fire_detections,
+            "weapon": weapon_detections
+        }
+
+    def check_events(self, metadata):
+        """Check for events to trigger recording (local logic)."""
+        # Select the detection with the highest confidence score
+        event_type = None
+        max_confidence = 0.0
+        
+        for det in metadata["fight"]:
+            if det["confidence"] > max_confidence:
+                max_confidence = det["confidence"]
+                event_type = "Violence"
+        
+        for det in metadata["fire"]:
+            if det["confidence"] > max_confidence:
+                max_confidence = det["confidence"]
+                event_type = "Fire"
+        
+        for det in metadata["weapon"]:
+            if det["confidence"] > max_confidence:
+                max_confidence = det["confidence"]
+                event_type = "Weapon"
+
+        if event_type:
+            current_time = time.time()
+            if current_time - self.last_event_time > self.cooldown_seconds:
+                self.last_event_time = current_time
+                
+                # Get snapshot of buffer safely, oldest frame first
+                with self.frame_lock:
+                    if self.ring_full:
+                        snapshot = np.concatenate((self.ring[self.ring_idx:], self.ring[:self.ring_idx]))
+                    else:
+                        snapshot = self.ring[:self.ring_idx].copy()
+                    
+                # Annotate the last frame in snapshot
+                if len(snapshot):
+                    cv2.putText(snapshot[-1], f"ALERT: {event_type}", (50, 50),
+                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
+                    
+                self.executor.submit(self.trigger_event, snapshot, event_type)
+
+    async def run_shared_memory(self):
+        """Same-host variant of run(): publishes frames and detections through shared memory."""
+        print(f"Publishing {CAMERA_ID} to the Livestream hub through shared memory.")
+        while self.is_running:
+            frame = self.get_latest_frame()
+            if frame is None:
+                # No new frame yet
+                await asyncio.sleep(0.01)
+                continue
+            
+            metadata, fresh = await self.detect_subsampled(frame)
+            if fresh:
+                self.check_events(metadata)
+            
+            # Encoding is CPU-bound, keep it off the event loop
+            buffer = await asyncio.to_thread(encode_jpeg, frame)
+            if buffer is not None:
+                self.shared_slot.write(buffer, orjson.dumps(metadata, option=orjson.OPT_SERIALIZE_NUMPY))
 
     async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.http = httpx.AsyncClient(
+            timeout=UPLOAD_TIMEOUT,
+            transport=httpx.AsyncHTTPTransport(limits=UPLOAD_LIMITS, retries=UPLOAD_RETRIES),
+        )
+        try:
+            if self.shared_slot is not None:
+                await self.run_shared_memory()
+            else:
+                await self.run_websocket()
+        finally:
+            await self.http.aclose()
+
+    async def write_messages(self, websocket, write_q, write_evt):
+        """Writer task: drains queued (metadata, frame) pairs onto the socket in order."""
+        while True:
+            await write_evt.wait()
+            write_evt.clear()
+            while write_q:
+                metadata, buffer = write_q.popleft()
+                await websocket.send(metadata)
+                await websocket.send(buffer)
+
+    async def run_websocket(self):
         print(f"Connecting to Livestream: {LIVESTREAM_URL}")
         
-        async for websocket in websockets.connect(LIVESTREAM_URL):
+        async for websocket in websockets.connect(LIVESTREAM_URL, **WS_CONNECT_OPTIONS):
             print("Connected to Livestream WebSocket.")
+            # Only the writer task touches the socket, so a slow drain never holds up detection.
+            # When it falls behind, the deque drops the oldest pair.
+            write_q = deque(maxlen=WRITE_QUEUE_SIZE)
+            write_evt = asyncio.Event()
+            writer = asyncio.create_task(self.write_messages(websocket, write_q, write_evt))
             try:
                 while self.is_running:
+                    if writer.done():
+                        # Re-raises the send error (e.g. ConnectionClosed) to reconnect
+                        writer.result()
+                    
                     # Get latest frame from thread
-                    frame = None
-                    with self.frame_lock:
-                        if self.latest_frame is not None:
-                            frame = self.latest_frame.copy()
+                    frame = self.get_latest_frame()
                             
                     if frame is None:
-                        # No frame yet
-                        await asyncio.sleep(0.1)
+                        # No new frame yet
+                        await asyncio.sleep(0.01)
                         continue
                         
-                    # Run Detections in parallel
-                    # Using asyncio.gather to run all detections concurrently
-                    fight_detections, fire_detections, weapon_detections = await asyncio.gather(
-                        asyncio.to_thread(self.fight_detector.detect, frame, conf_threshold=0.5),
-                        asyncio.to_thread(self.fire_detector.detect, frame, conf_threshold=0.5),
-                        asyncio.to_thread(self.weapon_detector.detect, frame, conf_threshold=0.5)
-                    )
-                    
-                    # Prepare Metadata
-                    import json
-                    metadata = {
-                        "type": "detections",
-                        "fight": fight_detections,
-                        "fire": fire_detections,
-                        "weapon": weapon_detections
-                    }
-                    
-                    # Send Metadata (Text)
-                    try:
-                        await websocket.send(json.dumps(metadata))
-                    except Exception as e:
-                        print(f"WS Send JSON Error: {e}")
-                        break
-
-                    # Check for events to trigger recording (local logic)
-                    # Select the detection with the highest confidence score
-                    event_type = None
-                    max_confidence = 0.0
-                    
-                    for det in fight_detections:
-                        if det["confidence"] > max_confidence:
-                            max_confidence = det["confidence"]
-                            event_type = "Violence"
-                    
-                    for det in fire_detections:
-                        if det["confidence"] > max_confidence:
-                            max_confidence = det["confidence"]
-                            event_type = "Fire"
-                    
-                    for det in weapon_detections:
-                        if det["confidence"] > max_confidence:
-                            max_confidence = det["confidence"]
-                            event_type = "Weapon"
-
-                    if event_type:
-                        current_time = time.time()
-                        if current_time - self.last_event_time > self.cooldown_seconds:
-                            self.last_event_time = current_time
-                            
-                            # Get snapshot of buffer safely
-                            with self.frame_lock:
-                                snapshot = list(self.frame_buffer)
-                                
-                            # Annotate the last frame in snapshot
-                            if snapshot:
-                                rec_frame = snapshot[-1].copy()
-                                cv2.putText(rec_frame, f"ALERT: {event_type}", (50, 50),
-                                        cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
-                                snapshot[-1] = rec_frame
-                                
-                            self.trigger_event(snapshot, event_type)
-
-                    # Send Clean Frame (Binary)
-                    try:
-                        ret_enc, buffer = cv2.imencode('.jpg', frame)
-                        if ret_enc:
-                            await websocket.send(buffer.tobytes())
-                    except Exception as e:
-                        print(f"WS Send Image Error: {e}")
-                        break # Break inner loop to reconnect
-
-                    # Small sleep to yield to event loop
-                    await asyncio.sleep(0.01)
+                    metadata, fresh = await self.detect_subsampled(frame)
+
+                    if fresh:
+                        self.check_events(metadata)
+
+                    # Encoding is CPU-bound, keep it off the event loop
+                    buffer = await asyncio.to_thread(encode_jpeg, frame)
+                    if buffer is not None:
+                        # Metadata is decoded so it goes out as a text message; the hub treats binary as frames
+                        write_q.append((orjson.dumps(metadata, option=orjson.OPT_SERIALIZE_NUMPY).decode(), buffer))
+                        write_evt.set()
             except websockets.exceptions.ConnectionClosed:
                 print("WebSocket connection closed. Reconnecting...")
                 await asyncio.sleep(3)
             except Exception as e:
                 print(f"Error in run loop: {e}")
                 await asyncio.sleep(3)
+            finally:
+                writer.cancel()
 
 if __name__ == "__main__":
     system = VisionSystem()
     try:
-        asyncio.run(system.run())
+        (uvloop.run if uvloop is not None else asyncio.run)(system.run())
     except KeyboardInterrupt:
         print("Stopping...")
         system.is_running = False
         system.cap.release()
+        if system.shared_slot is not None:
+            system.shared_slot.close()
@@ -1,6 +1,13 @@
 import cv2
+import numpy as np
 import sys
 import os
+import time
+import queue
+import signal
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Add the current directory to sys.path to ensure imports work correctly
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -9,80 +16,228 @@ sys.path.append(current_dir)
 from fight_detection.model import FightDetector
 from weapon_detection.model import WeaponDetector
 from crowd_detection.model import CrowdDetector
+from yolo_runtime import resize_for_inference, limit_cpu_threads, core_pinning_initializer
+
+# People count above which the crowd warning fires
+CROWD_LIMIT = 20
+
+# How often the capture thread logs how many frames it dropped
+DROP_REPORT_SECONDS = 30
+
+# Frames collected before running the detectors, so each model does one batched pass
+BATCH = 4
+
+# Fights and weapons change slowly between frames: run those models on every Nth batch and
+# reuse their latest detections in between. The crowd count runs on every batch.
+FIGHT_EVERY = 2
+WEAPON_EVERY = 3
+
+def open_camera(index):
+    """Open a webcam with MJPG over USB and a one-frame driver queue, so reads aren't stale."""
+    backend = cv2.CAP_DSHOW if sys.platform == "win32" else cv2.CAP_V4L2 if sys.platform.startswith("linux") else cv2.CAP_ANY
+    cap = cv2.VideoCapture(index, backend)
+    if not cap.isOpened():
+        cap = cv2.VideoCapture(index)
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap
+
+def capture_worker(cap, frames, stop):
+    """Read the camera on its own thread so capture overlaps inference and drawing."""
+    dropped = 0
+    last_report = time.monotonic()
+    while not stop.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            print("Error: Could not read frame.")
+            frame = None
+        # When inference falls behind, drop the oldest frame rather than lag further
+        if frames.full():
+            try:
+                frames.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
+        frames.put(frame)
+        now = time.monotonic()
+        if now - last_report >= DROP_REPORT_SECONDS:
+            print(f"Dropped {dropped} frames in the last {now - last_report:.0f}s (inference falling behind)")
+            dropped = 0
+            last_report = now
+        if frame is None:
+            break
+
+def scale_boxes(batch_detections, scale):
+    """Map boxes found on resized frames back to full-frame coordinates, in place."""
+    if scale != 1.0:
+        for detections in batch_detections:
+            for det in detections:
+                det['bbox'] = [v / scale for v in det['bbox']]
+    return batch_detections
+
+def draw_detections(frame, fight_detections, weapon_detections, crowd_detections):
+    """Draw one frame's detections and the people count onto it."""
+    # Crowd Logic
+    person_count = len(crowd_detections)
+
+    # Draw Fight Detections (Red)
+    for det in fight_detections:
+        x1, y1, x2, y2 = map(int, det['bbox'])
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 255), 2)
+        cv2.putText(frame, f"{det['label']} {det['confidence']:.2f}", (x1, y1 - 10), 
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
+
+    # Draw Weapon Detections (Blue)
+    for det in weapon_detections:
+        x1, y1, x2, y2 = map(int, det['bbox'])
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 2)
+        cv2.putText(frame, f"{det['label']} {det['confidence']:.2f}", (x1, y1 - 30), 
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
+                
+    # Draw Crowd Detections (Green), every box in a single polylines call
+    if crowd_detections:
+        x1, y1, x2, y2 = np.array([det['bbox'] for det in crowd_detections], dtype=np.int32).T
+        corners = np.stack([x1, y1, x2, y1, x2, y2, x1, y2], axis=1).reshape(-1, 4, 2)
+        cv2.polylines(frame, corners, True, (0, 255, 0), 1)
+        # Maybe don't draw label for every person to avoid clutter
+    
+    # Draw Crowd Info
+    info_color = (0, 255, 0)
+    if person_count > CROWD_LIMIT:
+         info_color = (0, 0, 255) # Red warning
+         cv2.putText(frame, "WARNING: CROWD LIMIT EXCEEDED!", (50, 100), 
+                    cv2.FONT_HERSHEY_SIMPLEX, 1, info_color, 3)
+
+    cv2.putText(frame, f"People Count: {person_count}", (50, 50), 
+                cv2.FONT_HERSHEY_SIMPLEX, 1, info_color, 2)
 
 def main():
+    parser = argparse.ArgumentParser(description="Run the fight, weapon and crowd detectors on a webcam")
+    parser.add_argument("--headless", action="store_true", help="No window or drawing; only print alerts. Stop with Ctrl+C")
+    args = parser.parse_args()
+
+    # Ctrl+C stops the loop cleanly (the only way to quit when headless)
+    shutdown = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: shutdown.set())
+
     # Initialize Detectors
+    limit_cpu_threads(3)
     fight_detector = FightDetector()
     weapon_detector = WeaponDetector()
     crowd_detector = CrowdDetector()
     
     # Open the webcam (index 1 for OBS Virtual Camera)
-    cap = cv2.VideoCapture(1)
+    cap = open_camera(1)
     
     if not cap.isOpened():
         print("Error: Could not open video capture (1). Trying 0...")
-        cap = cv2.VideoCapture(0)
+        cap = open_camera(0)
     
     if not cap.isOpened():
          print("Error: Could not open any camera.")
          return
 
-    print("Press 'q' to quit.")
+    # Warm up on a full batch of camera-sized frames, so the first real batch doesn't pay
+    # for memory allocation and kernel selection at this shape
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH) or 640)
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT) or 480)
+    dummy, _ = resize_for_inference(np.zeros((height, width, 3), dtype=np.uint8))
+    for detector in (fight_detector, weapon_detector, crowd_detector):
+        detector.detect_batch([dummy] * BATCH)
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            print("Error: Could not read frame.")
-            break
+    print("Press Ctrl+C to quit." if args.headless else "Press 'q' to quit.")
+
+    # None from the capture thread means the camera stopped delivering frames
+    frames = queue.Queue(maxsize=BATCH)
+    stop = threading.Event()
+    capture_thread = threading.Thread(target=capture_worker, args=(cap, frames, stop), daemon=True)
+    capture_thread.start()
+
+    # One single-worker executor per detector: detectors overlap (each on its own CUDA stream),
+    # but a detector never runs two batches at once, since its Ultralytics predictor isn't thread-safe
+    pin_worker = core_pinning_initializer(3)
+    fight_pool, weapon_pool, crowd_pool = (ThreadPoolExecutor(max_workers=1, initializer=pin_worker) for _ in range(3))
+
+    pending_frames = []
+    batch_id = 0
+    last_fight = []
+    last_weapon = []
+    # Batch whose detections are still running, shown once the next batch has been submitted
+    in_flight = None
+    running = True
+
+    def show_batch(batch_frames, scale, fight_future, weapon_future, crowd_future):
+        """Wait for a batch's detections, then draw and show its frames. Returns False on 'q'."""
+        nonlocal last_fight, last_weapon
+        if fight_future is not None:
+            fight_batch = scale_boxes(fight_future.result(), scale)
+            last_fight = fight_batch[-1]
+        else:
+            fight_batch = [last_fight] * len(batch_frames)
+        if weapon_future is not None:
+            weapon_batch = scale_boxes(weapon_future.result(), scale)
+            last_weapon = weapon_batch[-1]
+        else:
+            weapon_batch = [last_weapon] * len(batch_frames)
+        crowd_batch = scale_boxes(crowd_future.result(), scale)
 
-        # Run Detections
-        fight_detections = fight_detector.detect(frame)
-        weapon_detections = weapon_detector.detect(frame, conf_threshold=0.4)
-        crowd_detections = crowd_detector.detect(frame, conf_threshold=0.5)
-        
-        # Crowd Logic
-        person_count = len(crowd_detections)
-        
-        # Draw Fight Detections (Red)
-        for det in fight_detections:
-            x1, y1, x2, y2 = map(int, det['bbox'])
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 255), 2)
-            cv2.putText(frame, f"{det['label']} {det['confidence']:.2f}", (x1, y1 - 10), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
-
-        # Draw Weapon Detections (Blue)
-        for det in weapon_detections:
-            x1, y1, x2, y2 = map(int, det['bbox'])
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 2)
-            cv2.putText(frame, f"{det['label']} {det['confidence']:.2f}", (x1, y1 - 30), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
-                        
-        # Draw Crowd Detections (Green)
-        for det in crowd_detections:
-            x1, y1, x2, y2 = map(int, det['bbox'])
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 1)
-            # Maybe don't draw label for every person to avoid clutter
-            
-        # Draw Crowd Info
-        info_color = (0, 255, 0)
-        if person_count > 20:
-             info_color = (0, 0, 255) # Red warning
-             cv2.putText(frame, "WARNING: CROWD LIMIT EXCEEDED!", (50, 100), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 1, info_color, 3)
-             print(f"ALERT: Crowd limit exceeded! Count: {person_count}")
-
-        cv2.putText(frame, f"People Count: {person_count}", (50, 50), 
-                    cv2.FONT_HERSHEY_SIMPLEX, 1, info_color, 2)
-
-        # Show the frame
-        cv2.imshow("Vision Model Test", frame)
-
-        # Quit on 'q' press
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        for frame, fight_detections, weapon_detections, crowd_detections in zip(
+                batch_frames, fight_batch, weapon_batch, crowd_batch):
+            if len(crowd_detections) > CROWD_LIMIT:
+                print(f"ALERT: Crowd limit exceeded! Count: {len(crowd_detections)}")
+            if args.headless:
+                continue
+
+            draw_detections(frame, fight_detections, weapon_detections, crowd_detections)
+
+            # Show the frame
+            cv2.imshow("Vision Model Test", frame)
+
+            # Quit on 'q' press
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                return False
+        return True
+
+    # imshow/waitKey stay on the main thread (HighGUI requirement), so instead of a display
+    # thread the previous batch is drawn and shown while the detectors work on the next one
+    while running and not shutdown.is_set():
+        frame = frames.get()
+        if frame is None:
             break
 
+        pending_frames.append(frame)
+        if len(pending_frames) < BATCH:
+            continue
+
+        # Resize once for all three detectors; boxes are mapped back to the full frames when shown
+        resized = [resize_for_inference(f) for f in pending_frames]
+        infer_frames = [small for small, _ in resized]
+        scale = resized[0][1]
+
+        # Run Detections concurrently, one forward pass per model for the whole batch
+        fight_future = weapon_future = None
+        if batch_id % FIGHT_EVERY == 0:
+            fight_future = fight_pool.submit(fight_detector.detect_batch, infer_frames)
+        if batch_id % WEAPON_EVERY == 0:
+            weapon_future = weapon_pool.submit(weapon_detector.detect_batch, infer_frames, conf_threshold=0.4)
+        crowd_future = crowd_pool.submit(crowd_detector.detect_batch, infer_frames, conf_threshold=0.5)
+        batch_id += 1
+
+        if in_flight is not None:
+            running = show_batch(*in_flight)
+        in_flight = (pending_frames, scale, fight_future, weapon_future, crowd_future)
+        pending_frames = []
+
+    if running and in_flight is not None:
+        show_batch(*in_flight)
+
+    stop.set()
+    capture_thread.join(timeout=1)
+    for pool in (fight_pool, weapon_pool, crowd_pool):
+        pool.shutdown()
     cap.release()
-    cv2.destroyAllWindows()
+    if not args.headless:
+        cv2.destroyAllWindows()
 
 if __name__ == "__main__":
     main()
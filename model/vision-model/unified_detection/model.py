@@ -0,0 +1,87 @@
+import os
+import numpy as np
+from yolo_runtime import load_model, create_stream, predict_on_stream, class_names, predict_args
+
+# Class ids of the combined checkpoint (see combined.yaml) and the detection group each one feeds
+CLASS_GROUPS = {
+    0: "fire",
+    1: "fight",
+    2: "weapon",
+    3: "person",
+}
+
+class UnifiedDetector:
+    def __init__(self, model_path=None):
+        """
+        Initialize the UnifiedDetector model.
+
+        One YOLO checkpoint trained on the merged fire / violence / weapon / person
+        datasets, so a frame goes through a single backbone instead of one per detector.
+
+        Args:
+            model_path (str): Path to the YOLO weights file.
+                              If None, defaults to 'yolov8/unified.pt' relative to this file.
+        """
+        if model_path is None:
+            current_dir = os.path.dirname(os.path.abspath(__file__))
+            model_path = os.path.join(current_dir, 'yolov8', 'unified.pt')
+
+        print(f"Loading Unified Detection Model from: {model_path}")
+        self.model = load_model(model_path)
+        self.cuda_stream = create_stream()
+        # Label per class id, looked up once instead of per detection
+        self.names = class_names(self.model)
+
+    def detect(self, frame, conf_threshold=0.5):
+        """
+        Detect fire, violence, weapons and people in a frame.
+
+        Args:
+            frame (numpy.ndarray): Input image/frame.
+            conf_threshold (float): Confidence threshold for detection.
+
+        Returns:
+            dict: Lists of detections keyed by group ("fire", "fight", "weapon", "person").
+        """
+        # Run inference
+        results = predict_on_stream(self.model, self.cuda_stream, frame)
+        return self.group_detections(results, conf_threshold)
+
+    def stream(self, source, conf_threshold=0.5):
+        """
+        Let Ultralytics open the source and run capture, preprocessing and inference
+        in its own threaded loader.
+
+        Args:
+            source (int | str): Camera index or video path/URL.
+            conf_threshold (float): Confidence threshold for detection.
+
+        Yields:
+            tuple: (original BGR frame, detections grouped as in detect()) for every frame.
+        """
+        for result in self.model.predict(source=source, stream=True, **predict_args()):
+            yield result.orig_img, self.group_detections([result], conf_threshold)
+
+    def group_detections(self, results, conf_threshold):
+        """Turn Ultralytics results into lists of detections keyed by group."""
+        detections = {group: [] for group in CLASS_GROUPS.values()}
+
+        for result in results:
+            # One device->host transfer for all boxes instead of several per box
+            boxes = result.boxes.cpu().numpy()
+            xyxy = boxes.xyxy
+            confs = boxes.conf
+            cls_ids = boxes.cls.astype(int)
+            for i in np.flatnonzero(confs >= conf_threshold):
+                cls_id = int(cls_ids[i])
+                group = CLASS_GROUPS.get(cls_id)
+                if group is None:
+                    continue
+                detections[group].append({
+                    "bbox": xyxy[i].tolist(),
+                    "confidence": float(confs[i]),
+                    "class_id": cls_id,
+                    "label": "Violence" if group == "fight" else self.names[cls_id]
+                })
+
+        return detections
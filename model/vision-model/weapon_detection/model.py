@@ -1,5 +1,6 @@
-from ultralytics import YOLO
 import os
+import numpy as np
+from yolo_runtime import load_model, create_stream, predict_on_stream, class_names
 
 class WeaponDetector:
     def __init__(self, model_path=None):
@@ -24,7 +25,10 @@ class WeaponDetector:
             model_path = os.path.join(current_dir, 'Weapons-and-Knives-Detector-with-YOLOv8', 'runs', 'detect', 'Normal', 'weights', 'best.pt')
             
         print(f"Loading Weapon Detection Model from: {model_path}")
-        self.model = YOLO(model_path)
+        self.model = load_model(model_path)
+        self.cuda_stream = create_stream()
+        # Label per class id, looked up once instead of per detection
+        self.names = class_names(self.model)
         
     def detect(self, frame, conf_threshold=0.4):
         """
@@ -37,26 +41,39 @@ class WeaponDetector:
         Returns:
             list: List of detections.
         """
+        return self.detect_batch([frame], conf_threshold)[0]
+
+    def detect_batch(self, frames, conf_threshold=0.4):
+        """
+        Detect weapons in several frames with one batched inference call.
+
+        Args:
+            frames (list): Input images/frames (numpy.ndarray).
+            conf_threshold (float): Confidence threshold for detection.
+
+        Returns:
+            list: One list of detections per frame, in order.
+        """
         # Run inference
-        results = self.model(frame, verbose=False)
+        results = predict_on_stream(self.model, self.cuda_stream, frames)
         
-        detections = []
+        batch_detections = []
         
         for result in results:
-            boxes = result.boxes
-            for box in boxes:
-                conf = float(box.conf[0])
-                
-                if conf >= conf_threshold:
-                    x1, y1, x2, y2 = box.xyxy[0].tolist()
-                    cls_id = int(box.cls[0])
-                    label = self.model.names[cls_id]
-                    
-                    detections.append({
-                        "bbox": [x1, y1, x2, y2],
-                        "confidence": conf,
-                        "class_id": cls_id,
-                        "label": label
-                    })
+            detections = []
+            # One device->host transfer for all boxes instead of several per box
+            boxes = result.boxes.cpu().numpy()
+            xyxy = boxes.xyxy
+            confs = boxes.conf
+            cls_ids = boxes.cls.astype(int)
+            for i in np.flatnonzero(confs >= conf_threshold):
+                cls_id = int(cls_ids[i])
+                detections.append({
+                    "bbox": xyxy[i].tolist(),
+                    "confidence": float(confs[i]),
+                    "class_id": cls_id,
+                    "label": self.names[cls_id]
+                })
+            batch_detections.append(detections)
         
-        return detections
+        return batch_detections
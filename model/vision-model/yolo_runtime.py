@@ -0,0 +1,200 @@
+from ultralytics import YOLO
+import os
+import shutil
+import itertools
+import cv2
+import numpy as np
+import torch
+
+# Run on the first GPU with FP16 when one is available, otherwise FP32 on the CPU
+DEVICE = 0 if torch.cuda.is_available() else "cpu"
+HALF = DEVICE != "cpu"
+IMGSZ = 640
+# Largest batch the exported TensorRT engines accept (test.py runs the detectors on batches of frames)
+ENGINE_BATCH = int(os.getenv("ENGINE_BATCH", "4"))
+# Opt-in: build a missing TensorRT engine the first time a .pt model is loaded on the GPU.
+# Takes minutes per model, so engines are normally built up front with export_engine.py.
+AUTO_EXPORT_ENGINE = os.getenv("AUTO_EXPORT_ENGINE", "0") == "1"
+# Dataset yaml with a few hundred representative camera frames. When set, the auto-export
+# builds an INT8 engine (<weights>.int8.engine), which is preferred over the FP16 one.
+INT8_CALIB_DATA = os.getenv("INT8_CALIB_DATA")
+
+# Loaded models, keyed by weights path, so each file is only loaded once per process
+_models = {}
+# Arguments each model's predictor was last set up with (see run_model)
+_predictor_args = {}
+
+def limit_cpu_threads(parallel_models):
+    """
+    On CPU, split the cores between models that run at the same time so their
+    intra-op thread pools don't oversubscribe the machine.
+    """
+    if DEVICE == "cpu":
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // parallel_models))
+        try:
+            # The models already run side by side on our own threads
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Can only be set before torch has started any inter-op work
+            pass
+
+def core_pinning_initializer(parallel_models):
+    """
+    ThreadPoolExecutor initializer that pins each worker thread to its own slice of
+    the CPU cores, so concurrent detectors don't evict each other's caches.
+    Does nothing on GPU or where thread affinity isn't supported (Linux only).
+    """
+    if DEVICE != "cpu" or not hasattr(os, "sched_setaffinity"):
+        return None
+
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cores) // parallel_models)
+    next_slot = itertools.count()
+
+    def pin_worker():
+        slot = next(next_slot) % parallel_models
+        # pid 0 is the calling thread
+        os.sched_setaffinity(0, cores[slot * per_worker:(slot + 1) * per_worker] or cores)
+
+    return pin_worker
+
+def engine_paths(model_path):
+    """Paths of the (INT8, FP16) TensorRT engines exported next to the weights."""
+    stem = os.path.splitext(str(model_path))[0]
+    return stem + ".int8.engine", stem + ".engine"
+
+def export_engine(model_path, int8=False, data=None, imgsz=IMGSZ, device=DEVICE):
+    """
+    Export YOLO weights to a TensorRT engine next to them (FP16, or INT8 with
+    calibration data), with a dynamic batch of up to ENGINE_BATCH frames.
+
+    Returns:
+        str: Path of the saved engine.
+    """
+    source = model_path
+    if int8:
+        # Ultralytics names the engine after the weights, so export from a <stem>.int8.pt
+        # copy to get <stem>.int8.engine and leave the FP16 engine in place
+        source = os.path.splitext(str(model_path))[0] + ".int8.pt"
+        shutil.copyfile(model_path, source)
+    try:
+        return YOLO(source).export(
+            format="engine",
+            half=not int8,
+            int8=int8,
+            data=data,
+            imgsz=imgsz,
+            batch=ENGINE_BATCH,
+            dynamic=True,
+            simplify=True,
+            device=device,
+        )
+    finally:
+        if source != model_path:
+            os.remove(source)
+
+def load_model(model_path):
+    """
+    Load a YOLO model once, fuse its Conv+BN layers and run a warmup inference.
+
+    Args:
+        model_path (str): Path to the YOLO weights file.
+
+    Returns:
+        YOLO: The shared model instance for this path.
+    """
+    model = _models.get(model_path)
+    if model is None:
+        # Prefer a TensorRT engine exported next to the weights (see export_engine.py):
+        # INT8, then FP16, then the weights themselves
+        load_path = model_path
+        int8_path, engine_path = engine_paths(model_path)
+        if DEVICE != "cpu" and AUTO_EXPORT_ENGINE and str(model_path).endswith(".pt"):
+            if INT8_CALIB_DATA and not os.path.exists(int8_path):
+                print(f"No INT8 TensorRT engine for {model_path}, calibrating one on {INT8_CALIB_DATA} (this takes a while)...")
+                try:
+                    export_engine(model_path, int8=True, data=INT8_CALIB_DATA)
+                except Exception as e:
+                    print(f"INT8 export failed, falling back to FP16: {e}")
+            if not os.path.exists(int8_path) and not os.path.exists(engine_path):
+                print(f"No TensorRT engine for {model_path}, exporting one (this takes a few minutes)...")
+                try:
+                    export_engine(model_path)
+                except Exception as e:
+                    # e.g. TensorRT not installed; keep running the PyTorch weights
+                    print(f"TensorRT export failed, using PyTorch weights: {e}")
+        if DEVICE != "cpu":
+            for path in (int8_path, engine_path):
+                if os.path.exists(path):
+                    print(f"Using TensorRT engine: {path}")
+                    load_path = path
+                    break
+        model = YOLO(load_path)
+        # Exported formats (.engine, .onnx, ...) are already fused
+        if str(load_path).endswith(".pt"):
+            model.fuse()
+        # The first call pays for CUDA context setup and kernel selection
+        run_model(model, np.zeros((IMGSZ, IMGSZ, 3), dtype=np.uint8))
+        _models[model_path] = model
+    return model
+
+def class_names(model):
+    """
+    The model's class names as a plain list indexed by class id. YOLO.names is a
+    property that re-checks the names on every access, so detectors cache this instead.
+    """
+    names = model.names
+    if isinstance(names, dict):
+        return [str(names.get(i, i)) for i in range(max(names) + 1)]
+    return [str(name) for name in names]
+
+def predict_args(**overrides):
+    """Keyword arguments shared by every detector's inference call."""
+    args = {"imgsz": IMGSZ, "half": HALF, "device": DEVICE, "verbose": False}
+    args.update(overrides)
+    return args
+
+def run_model(model, frame, **overrides):
+    """
+    Run inference. Once the model's predictor has been set up with these arguments it is
+    called directly, skipping YOLO.predict's per-call config merge and validation.
+    """
+    args = predict_args(**overrides)
+    predictor = model.predictor
+    if predictor is not None and _predictor_args.get(predictor) == args:
+        return predictor(frame)
+    results = model.predict(frame, **args)
+    _predictor_args[model.predictor] = args
+    return results
+
+def resize_for_inference(frame):
+    """
+    Shrink a frame so its long side is IMGSZ, keeping the aspect ratio, so it can be
+    resized once and shared by every detector instead of each one resizing it again.
+
+    Returns:
+        tuple: (resized frame, scale applied). Divide boxes by the scale to map them back.
+    """
+    h, w = frame.shape[:2]
+    scale = IMGSZ / max(h, w)
+    if scale >= 1:
+        return frame, 1.0
+    size = (round(w * scale), round(h * scale))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_LINEAR), scale
+
+def create_stream():
+    """A CUDA stream for one detector, or None when running on the CPU."""
+    return torch.cuda.Stream(device=DEVICE) if DEVICE != "cpu" else None
+
+def predict_on_stream(model, stream, frame, **overrides):
+    """
+    Run inference on the detector's own CUDA stream so detectors called from
+    different threads can overlap their kernels. Waits for the stream before
+    returning, so the results are safe to read from any thread.
+    """
+    if stream is None:
+        return run_model(model, frame, **overrides)
+    with torch.cuda.stream(stream):
+        results = run_model(model, frame, **overrides)
+    stream.synchronize()
+    return results